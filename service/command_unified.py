@@ -1,11 +1,48 @@
+import functools
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import types
+from collections.abc import Mapping
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar, Union
 
 import pymongo
 
 
+def _json_default(value: Any) -> str:
+    """BSON Date等时间字段以ISO格式字符串输出，其他无法序列化的值（如ObjectId）转为字符串"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+try:
+    import orjson
+
+    def _json_dumps(value: Any) -> str:
+        # 与json.dumps一致接受非字符串键
+        return orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:  # orjson 为可选依赖，缺失时退回标准库
+    def _json_dumps(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, default=_json_default)
+
+
+# 与 integrated_workflow.py 中 idx_user_data 相同的复合索引键
+_BGU_INDEX = [("bot_id", 1), ("group_id", 1), ("user_id", 1)]
+
+# 已确认过索引的数据库（每个进程只创建一次）
+_INDEXED_DBS: set = set()
+
+
+def _index_hint(query: Dict[str, Any]) -> Optional[List[Tuple[str, int]]]:
+    """查询同时包含 bot_id 与 group_id 时强制走复合索引，其余交给查询规划器"""
+    if "bot_id" in query and "group_id" in query:
+        return _BGU_INDEX
+    return None
+
+
 class MongoDBSystem:
     """Lightweight MongoDB helper for command operations."""
 
@@ -14,30 +51,47 @@ class MongoDBSystem:
         self.db = self.client[db_name]
         self.collection = self.db["user_data"]
 
-    def find(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
-        return list(self.collection.find(query))
+        # 定义与 integrated_workflow.py 保持一致，已存在时为幂等操作；确保 hint 指向的索引存在
+        if db_name not in _INDEXED_DBS:
+            self.collection.create_index(_BGU_INDEX, unique=True, name="idx_user_data")
+            _INDEXED_DBS.add(db_name)
+
+    def find(self, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return list(self.collection.find(query, projection=projection, hint=_index_hint(query)))
 
-    def find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        return self.collection.find_one(query)
+    def iter_find(self, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None,
+                  batch_size: int = 500) -> pymongo.cursor.Cursor:
+        """按批次流式返回匹配文档，避免一次性物化全部结果"""
+        return self.collection.find(query, projection=projection, batch_size=batch_size,
+                                    hint=_index_hint(query))
+
+    def find_one(self, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        return self.collection.find_one(query, projection=projection, hint=_index_hint(query))
 
     def aggregate(self, pipeline: List[Dict[str, Any]]) -> pymongo.command_cursor.CommandCursor:
         """执行聚合管道查询"""
         return self.collection.aggregate(pipeline)
 
     def update_many(self, query: Dict[str, Any], updates: Dict[str, Any]) -> Tuple[int, int]:
-        result = self.collection.update_many(query, {"$set": updates})
+        result = self.collection.update_many(query, {"$set": updates}, hint=_index_hint(query))
         return result.matched_count, result.modified_count
 
     def update_one(self, query: Dict[str, Any], updates: Dict[str, Any]) -> Tuple[int, int]:
-        result = self.collection.update_one(query, {"$set": updates})
+        result = self.collection.update_one(query, {"$set": updates}, hint=_index_hint(query))
         return result.matched_count, result.modified_count
 
 
+@functools.lru_cache(maxsize=None)
+def get_system(mongo_url: str, db_name: str = "roza_database") -> MongoDBSystem:
+    """按连接参数缓存MongoDBSystem，同一进程内复用同一个MongoClient连接池"""
+    return MongoDBSystem(mongo_url, db_name)
+
+
 CommandParts = Tuple[str, str, Optional[str], bool, List[str]]
 
 
 def parse_command(user_query: str) -> CommandParts:
-    """Parse a command like /Roza.set.usage.total_tokens.any ...
+    """Parse a command like /Roza.set.usage.total_usage.total_tokens.any ...
 
     Returns: (action, type_key, field, has_any, params)
     """
@@ -51,7 +105,7 @@ def parse_command(user_query: str) -> CommandParts:
     params = tokens[1:]
 
     segments = command_token.lstrip("/").split(".")
-    # segments example: ["Roza", "set", "usage", "total_tokens", "any"]
+    # segments example: ["Roza", "set", "usage", "total_usage", "total_tokens", "any"]
     # or: ["Roza", "rank", "usage", "total_usage", "total_chat_count", "any"]
     if len(segments) < 3 or segments[0] != "Roza":
         return "", "", None, False, []
@@ -198,11 +252,38 @@ TYPE_DEFAULTS = {
 }
 
 
+
+def _freeze(value: Any) -> Any:
+    """递归转为只读结构（dict -> MappingProxyType，list -> tuple）"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """_freeze 的逆操作，生成可安全写入的普通 dict/list 副本"""
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+# clear 模板在多次指令间共享，冻结后任何原地修改都会直接报错
+for _conf in TYPE_DEFAULTS.values():
+    _conf["clear"] = _freeze(_conf["clear"])
+
+# set 允许写入的字段，按类型预先构建便于 O(1) 校验
+_VALID_FIELDS = {type_key: frozenset(conf["fields"]) for type_key, conf in TYPE_DEFAULTS.items()}
+
+
 def _get_nested(doc: Dict[str, Any], dotted: str) -> Any:
     parts = dotted.split(".")
     cur: Any = doc
     for part in parts:
-        if isinstance(cur, dict):
+        if isinstance(cur, Mapping):
             cur = cur.get(part)
         else:
             return None
@@ -235,31 +316,36 @@ def _format_context(entries: List[Dict[str, Any]], pool_size: int) -> str:
     return "\n\n".join(lines)
 
 
+PERSONA_LABELS = (
+    ("basic_info", "基本信息"),
+    ("living_habits", "生活习惯"),
+    ("psychological_traits", "心理特征"),
+    ("interests_preferences", "兴趣偏好"),
+    ("dislikes", "反感点"),
+    ("ai_expectations", "对AI的期望"),
+    ("memory_points", "希望记住的信息"),
+)
+
+_USAGE_TEMPLATE = "今日用量: {daily}\n总对话数: {chat}\n总Token: {tokens}\n输入Token: {prompt}\n输出Token: {output}"
+
+
 def _format_persona(attrs: Dict[str, Any]) -> str:
     if not isinstance(attrs, dict):
         return "数据格式错误"
-    keys = [
-        ("basic_info", "基本信息"),
-        ("living_habits", "生活习惯"),
-        ("psychological_traits", "心理特征"),
-        ("interests_preferences", "兴趣偏好"),
-        ("dislikes", "反感点"),
-        ("ai_expectations", "对AI的期望"),
-        ("memory_points", "希望记住的信息"),
-    ]
-    lines = [f"{label}: {attrs.get(key, '')}" for key, label in keys if key in attrs]
-    return "\n".join(lines) if lines else "暂无数据"
+    text = "\n".join(f"{label}: {attrs[key]}" for key, label in PERSONA_LABELS if key in attrs)
+    return text or "暂无数据"
 
 
 def _format_usage(total: Dict[str, Any], daily: Any) -> str:
     if not isinstance(total, dict):
         total = {}
-    lines = [f"今日用量: {daily}"]
-    lines.append(f"总对话数: {total.get('total_chat_count', 0)}")
-    lines.append(f"总Token: {total.get('total_tokens', 0)}")
-    lines.append(f"输入Token: {total.get('total_prompt_token', 0)}")
-    lines.append(f"输出Token: {total.get('total_output_token', 0)}")
-    return "\n".join(lines)
+    return _USAGE_TEMPLATE.format(
+        daily=daily,
+        chat=total.get("total_chat_count", 0),
+        tokens=total.get("total_tokens", 0),
+        prompt=total.get("total_prompt_token", 0),
+        output=total.get("total_output_token", 0),
+    )
 
 
 def _format_blacklist(stats: Dict[str, Any]) -> str:
@@ -273,12 +359,13 @@ def _format_blacklist(stats: Dict[str, Any]) -> str:
     )
 
 
-def _build_query(bot_id: str, group_id: str, target: str, has_any: bool) -> Dict[str, Any]:
-    if not has_any:
-        if target == "all":
-            return {"bot_id": bot_id, "group_id": group_id}
-        return {"bot_id": bot_id, "group_id": group_id, "user_id": target}
+def _build_query_normal(bot_id: str, group_id: str, target: str) -> Dict[str, Any]:
+    if target == "all":
+        return {"bot_id": bot_id, "group_id": group_id}
+    return {"bot_id": bot_id, "group_id": group_id, "user_id": target}
 
+
+def _build_query_any(target: str) -> Dict[str, Any]:
     # any mode accepts wildcard %
     parts = target.split(":")
     bid, gid, uid = (parts + ["", "", ""])[:3]
@@ -295,9 +382,9 @@ def _build_query(bot_id: str, group_id: str, target: str, has_any: bool) -> Dict
 def _validate_set_value(type_key: str, field: str, value: Any) -> Any:
     if type_key == "favor" and field in {"favor_value", "last_favor_change"}:
         return int(value)
-    if type_key == "blacklist" and field == "block_count":
+    if type_key == "blacklist" and field == "block_stats.block_count":
         return int(value)
-    if type_key == "blacklist" and field == "block_status":
+    if type_key == "blacklist" and field == "block_stats.block_status":
         if str(value).lower() in {"true", "1"}:
             return True
         if str(value).lower() in {"false", "0"}:
@@ -307,6 +394,80 @@ def _validate_set_value(type_key: str, field: str, value: Any) -> Any:
     return str(value)
 
 
+# get 各类型格式化所需的字段，服务端只返回这些字段
+GET_PROJECTIONS = {
+    "favor": {"user_id": 1, "favor_value": 1, "last_favor_change": 1},
+    "usage": {"user_id": 1, "daily_usage_count": 1, "total_usage": 1},
+    "memory": {"user_id": 1, "long_term_memory": 1},
+    "context": {"user_id": 1, "history_entries": 1},
+    "persona": {"user_id": 1, "persona_attributes": 1},
+    "blacklist": {"user_id": 1, "block_stats": 1},
+}
+
+
+def _get_projection(type_key: str, field: Optional[str], pool_size: int) -> Optional[Dict[str, Any]]:
+    """构建 get 的投影；context 在服务端用 $slice 截取最新 pool_size 条"""
+    if field:
+        return {"user_id": 1, field: 1}
+    if type_key == "context" and pool_size > 0:
+        return {"user_id": 1, "history_entries": {"$slice": -pool_size}}
+    return GET_PROJECTIONS.get(type_key)
+
+
+def _scoped_query(bot_id: str, group_id: str, target: str, cross_enabled: bool) -> Dict[str, Any]:
+    """非 any 模式的 set/clear 查询；开启跨群时覆盖同一 bot 下的所有群"""
+    query: Dict[str, Any] = {"bot_id": bot_id}
+    if target != "all":
+        query["user_id"] = target
+    if not cross_enabled:
+        query["group_id"] = group_id
+    return query
+
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+# 多参数写操作的最大并发数
+MAX_PARALLEL_OPS = 8
+
+# 多参数写操作共用的线程池，首次需要并发时创建，进程内复用
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """获取（必要时创建）共享线程池"""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_PARALLEL_OPS, thread_name_prefix="roza-cmd")
+    return _EXECUTOR
+
+
+def _targets_disjoint(targets: Sequence[str], has_any: bool) -> bool:
+    """
+    各参数写入的文档集合是否两两不相交
+
+    只有互不相同的具体用户ID才能保证；all 与 any 模式的匹配范围可能与其他参数重叠，
+    重叠时必须按参数顺序写入，最后一个参数的值生效
+    """
+    if has_any or "all" in targets:
+        return False
+    return len(set(targets)) == len(targets)
+
+
+def _run_ordered(func: Callable[[_T], _R], items: Sequence[_T], parallel: bool) -> List[_R]:
+    """
+    按参数执行写操作，结果顺序与输入一致
+
+    parallel=True（调用方已确认各操作互不重叠）时并发执行（共享同一连接池），否则按顺序执行
+    """
+    if not parallel or len(items) <= 1:
+        return [func(item) for item in items]
+    return list(_get_executor().map(func, items))
+
+
 def _log_entry(command_type: str, modified: int, target: str, result: str) -> Dict[str, Any]:
     return {
         "command_type": command_type,
@@ -319,7 +480,7 @@ def _log_entry(command_type: str, modified: int, target: str, result: str) -> Di
 def _extract_value(doc: Dict[str, Any], type_key: str, field: Optional[str], pool_size: int) -> str:
     if field:
         val = _get_nested(doc, field)
-        return "字段不存在" if val is None else json.dumps(val, ensure_ascii=False)
+        return "字段不存在" if val is None else _json_dumps(val)
 
     if type_key == "favor":
         return f"好感度: {doc.get('favor_value', 0)}\n最后变化: {doc.get('last_favor_change', 0)}"
@@ -339,29 +500,44 @@ def _extract_value(doc: Dict[str, Any], type_key: str, field: Optional[str], poo
 
 
 def _apply_clear(mongo: MongoDBSystem, query: Dict[str, Any], type_key: str, field: Optional[str]) -> Tuple[int, int]:
-    updates: Dict[str, Any] = {}
+    now_iso = datetime.utcnow().isoformat()
+    plan = TYPE_DEFAULTS.get(type_key, {}).get("clear", {})
     if field:
         # precise clear
         if type_key == "usage" and field.startswith("total_usage"):
             # allow clearing totals only when precise
-            updates = {field: 0}
+            value: Any = 0
         elif type_key == "blacklist" and field == "block_stats.last_operate_time":
-            updates = {field: datetime.utcnow().isoformat()}
+            value = now_iso
         else:
-            updates = {field: _get_nested(TYPE_DEFAULTS.get(type_key, {}).get("clear", {}), field) or (0 if "_count" in field or field.endswith("count") else "")}
+            value = _get_nested(plan, field) or (0 if "_count" in field or field.endswith("count") else "")
+        updates = {field: value, "updated_at": now_iso}
     else:
-        # type-level clear
-        updates = TYPE_DEFAULTS.get(type_key, {}).get("clear", {})
-    updates["updated_at"] = datetime.utcnow().isoformat()
+        # type-level clear：由只读模板生成新的 updates，不会污染共享常量
+        updates = {**_thaw(plan), "updated_at": now_iso}
+        if type_key == "blacklist":
+            # 操作时间取清空时刻而非模板构建时刻
+            updates["block_stats"]["last_operate_time"] = now_iso
     return mongo.update_many(query, updates)
 
 
-def _apply_set(mongo: MongoDBSystem, query: Dict[str, Any], type_key: str, field: str, value: Any) -> Tuple[int, int]:
-    try:
-        coerced = _validate_set_value(type_key, field, value)
-    except ValueError:
-        raise
+def _clear_context_entries(mongo: MongoDBSystem, query: Dict[str, Any], pool_size: int) -> Tuple[int, int]:
+    """删除最新 context_pool_size 条历史记录而非清空"""
+    docs = mongo.find(query)
+    modified = 0
+    for doc in docs:
+        hist = doc.get("history_entries", [])
+        if not isinstance(hist, list) or not hist:
+            continue
+        keep = hist[:-pool_size] if pool_size > 0 else hist
+        if len(keep) != len(hist):
+            update_res = mongo.collection.update_one({"_id": doc["_id"]}, {"$set": {"history_entries": keep, "updated_at": datetime.utcnow().isoformat()}})
+            modified += update_res.modified_count
+    return len(docs), modified
+
 
+def _apply_set(mongo: MongoDBSystem, query: Dict[str, Any], type_key: str, field: str, coerced: Any) -> Tuple[int, int]:
+    """写入已经过 _validate_set_value 校验转换的值"""
     updates: Dict[str, Any] = {field: coerced, "updated_at": datetime.utcnow().isoformat()}
     # for favor_value also mirror last_favor_change when setting explicitly
     if type_key == "favor" and field == "favor_value":
@@ -481,6 +657,11 @@ def execute_command(
         response["logs"] = "[]"
         return response
 
+    if action == "set" and field not in _VALID_FIELDS.get(type_key, ()):
+        response["result"] = "字段不被允许"
+        response["logs"] = "[]"
+        return response
+
     if action == "rank":
         if not field:
             response["result"] = "rank指令必须指定精确字段"
@@ -500,7 +681,7 @@ def execute_command(
         # 使用解析后的完整字段
         field = resolved_field
 
-    mongo = MongoDBSystem(mongo_url)
+    mongo = get_system(mongo_url)
 
     result_lines: List[str] = []
     logs: List[str] = []
@@ -514,109 +695,96 @@ def execute_command(
         "blacklist": blacklist_cross_group,
     }
 
-    if action in {"get", "clear"}:
+    if action == "get":
+        # 非 any 模式下多个用户的 get 合并为一次 $in 查询
+        prefetched: Optional[Dict[str, Dict[str, Any]]] = None
+        projection = _get_projection(type_key, field, pool_size)
+        if not has_any:
+            user_ids = [p for p in params if p != "all"]
+            if len(user_ids) > 1:
+                prefetched = {
+                    doc.get("user_id"): doc
+                    for doc in mongo.find(
+                        {"bot_id": bot_id, "group_id": group_id, "user_id": {"$in": user_ids}}, projection
+                    )
+                }
+
+        # has_any 在一次指令内不变，预先选定查询构建函数
+        build_query: Callable[[str], Dict[str, Any]] = (
+            _build_query_any if has_any else functools.partial(_build_query_normal, bot_id, group_id)
+        )
         for param in params:
-            query = _build_query(bot_id, group_id, param, has_any)
-            targets: List[Dict[str, Any]] = []
-
-            if action == "get":
-                if param == "all" or has_any:
-                    targets = mongo.find(query)
-                else:
-                    doc = mongo.find_one(query)
-                    if doc:
-                        targets = [doc]
-                if not targets:
-                    result_lines.append(f"[{param}: 用户不存在]")
-                    logs.append(_log_entry(command_label, 0, param, "not found"))
-                    continue
-                for doc in targets:
-                    uid = doc.get("user_id", "")
-                    val = _extract_value(doc, type_key, field, pool_size)
-                    result_lines.append(f"[{uid}:\n{val}]")
-                    logs.append(_log_entry(command_label, 1, uid or param, "ok"))
-                    total_queried += 1
-                continue
-
-            # clear branch
-            if has_any:
-                # any mode: use wildcard query from _build_query
-                pass  # query already built
-            else:
-                # normal mode: apply cross-group logic
-                cross_enabled = bool(cross_group_map.get(type_key, False))
-                if param == "all":
-                    query = {"bot_id": bot_id}
-                    if not cross_enabled:
-                        query["group_id"] = group_id
-                else:
-                    query = {"bot_id": bot_id, "user_id": param}
-                    if not cross_enabled:
-                        query["group_id"] = group_id
-
-            if type_key == "context" and field is None:
-                # 删除最新 context_pool_size 条历史记录而非清空
-                docs = mongo.find(query)
-                matched = len(docs)
-                modified = 0
-                for doc in docs:
-                    hist = doc.get("history_entries", [])
-                    if not isinstance(hist, list) or not hist:
-                        continue
-                    keep = hist[:-pool_size] if pool_size > 0 else hist
-                    if len(keep) != len(hist):
-                        update_res = mongo.collection.update_one({"_id": doc["_id"]}, {"$set": {"history_entries": keep, "updated_at": datetime.utcnow().isoformat()}})
-                        modified += update_res.modified_count
-                total_modified += modified
+            query = build_query(param)
+            targets: Iterable[Dict[str, Any]] = []
+
+            if param == "all" or has_any:
+                # 游标逐批返回，边取边格式化
+                targets = mongo.iter_find(query, projection)
             else:
-                matched, modified = _apply_clear(mongo, query, type_key, field)
-                total_modified += modified
+                doc = prefetched.get(param) if prefetched is not None else mongo.find_one(query, projection)
+                if doc:
+                    targets = [doc]
+            found = 0
+            for doc in targets:
+                uid = doc.get("user_id", "")
+                val = _extract_value(doc, type_key, field, pool_size)
+                result_lines.append(f"[{uid}:\n{val}]")
+                logs.append(_log_entry(command_label, 1, uid or param, "ok"))
+                found += 1
+            if not found:
+                result_lines.append(f"[{param}: 用户不存在]")
+                logs.append(_log_entry(command_label, 0, param, "not found"))
+            total_queried += found
+
+    elif action == "clear":
+        cross_enabled = bool(cross_group_map.get(type_key, False))
+        queries = [
+            _build_query_any(param) if has_any
+            else _scoped_query(bot_id, group_id, param, cross_enabled)
+            for param in params
+        ]
+        parallel = _targets_disjoint(params, has_any)
+        if type_key == "context" and field is None:
+            outcomes = _run_ordered(lambda q: _clear_context_entries(mongo, q, pool_size), queries, parallel)
+        else:
+            outcomes = _run_ordered(lambda q: _apply_clear(mongo, q, type_key, field), queries, parallel)
 
-            target_label = param
-            result_lines.append(f"[{target_label}: 清空完成，匹配{matched}，修改{modified}]")
-            logs.append(_log_entry(command_label, modified, target_label, "ok" if matched else "not found"))
+        for param, (matched, modified) in zip(params, outcomes):
+            total_modified += modified
+            result_lines.append(f"[{param}: 清空完成，匹配{matched}，修改{modified}]")
+            logs.append(_log_entry(command_label, modified, param, "ok" if matched else "not found"))
 
     elif action == "set":
-        if has_any:
-            if len(params) < 2 or len(params) % 2 != 0:
-                response.update({"result": "any模式需要目标和值成对出现", "logs": json.dumps(logs, ensure_ascii=False)})
-                return response
-            for idx in range(0, len(params), 2):
-                target = params[idx]
-                value = params[idx + 1]
-                query = _build_query(bot_id, group_id, target, True)
-                try:
-                    matched, modified = _apply_set(mongo, query, type_key, field, value)
-                except ValueError as e:
-                    response.update({"result": str(e), "modified_count": total_modified, "logs": json.dumps(logs, ensure_ascii=False)})
-                    return response
-                total_modified += modified
-                result_lines.append(f"[{target}: 设置完成，匹配{matched}，修改{modified}]")
-                logs.append(_log_entry(command_label, modified, target, "ok" if matched else "not found"))
-        else:
-            if len(params) % 2 != 0:
-                response.update({"result": "参数数量不正确，对象和值必须成对出现", "logs": json.dumps(logs, ensure_ascii=False)})
-                return response
-            for idx in range(0, len(params), 2):
-                uid = params[idx]
-                value = params[idx + 1]
-                cross_enabled = bool(cross_group_map.get(type_key, False))
-                if uid == "all":
-                    query = {"bot_id": bot_id}
-                    if not cross_enabled:
-                        query["group_id"] = group_id
-                else:
-                    query = {"bot_id": bot_id, "user_id": uid}
-                    if not cross_enabled:
-                        query["group_id"] = group_id
-                try:
-                    matched, modified = _apply_set(mongo, query, type_key, field, value)
-                except ValueError as e:
-                    response.update({"result": str(e), "modified_count": total_modified, "logs": json.dumps(logs, ensure_ascii=False)})
-                    return response
-                total_modified += modified
-                result_lines.append(f"[{uid}: 设置完成，匹配{matched}，修改{modified}]")
-                logs.append(_log_entry(command_label, modified, uid, "ok" if matched else "not found"))
+        if has_any and (len(params) < 2 or len(params) % 2 != 0):
+            response.update({"result": "any模式需要目标和值成对出现", "logs": json.dumps(logs, ensure_ascii=False)})
+            return response
+        if not has_any and len(params) % 2 != 0:
+            response.update({"result": "参数数量不正确，对象和值必须成对出现", "logs": json.dumps(logs, ensure_ascii=False)})
+            return response
+
+        set_targets = params[0::2]
+        # 写入前统一校验，任一值非法时不做任何修改
+        try:
+            values = [_validate_set_value(type_key, field, value) for value in params[1::2]]
+        except ValueError as e:
+            response.update({"result": str(e), "modified_count": 0, "logs": json.dumps(logs, ensure_ascii=False)})
+            return response
+
+        cross_enabled = bool(cross_group_map.get(type_key, False))
+        queries = [
+            _build_query_any(target) if has_any
+            else _scoped_query(bot_id, group_id, target, cross_enabled)
+            for target in set_targets
+        ]
+        outcomes = _run_ordered(
+            lambda item: _apply_set(mongo, item[0], type_key, field, item[1]), list(zip(queries, values)),
+            _targets_disjoint(set_targets, has_any)
+        )
+
+        for target, (matched, modified) in zip(set_targets, outcomes):
+            total_modified += modified
+            result_lines.append(f"[{target}: 设置完成，匹配{matched}，修改{modified}]")
+            logs.append(_log_entry(command_label, modified, target, "ok" if matched else "not found"))
 
     elif action == "rank":
         # rank 操作的参数处理
@@ -638,15 +806,7 @@ def execute_command(
                     response["logs"] = "[]"
                     return response
             # 构建 any 模式的查询条件
-            parts = scope.split(":")
-            bid, gid, uid = (parts + ["", "", ""])[:3]
-            query: Dict[str, Any] = {}
-            if bid and bid != "%":
-                query["bot_id"] = bid
-            if gid and gid != "%":
-                query["group_id"] = gid
-            if uid and uid != "%":
-                query["user_id"] = uid
+            query = _build_query_any(scope)
         else:
             # 非 any 模式，在当前 bot_id 和 group_id 下查询
             query = {"bot_id": bot_id, "group_id": group_id}
@@ -1,13 +1,21 @@
+import functools
 import pymongo
 from datetime import datetime
 import re
-from typing import Dict, Any
+from typing import Dict, Any, List
+
+
+# 与 integrated_workflow.py 中 idx_user_data 相同的复合索引键
+_BGU_INDEX = [("bot_id", 1), ("group_id", 1), ("user_id", 1)]
+
+# 已确认过索引的数据库（每个进程只创建一次）
+_INDEXED_DBS: set = set()
 
 
 class MongoDBSystem:
     """统一的MongoDB系统 - 管理所有数据库操作
 
-    注意: 索引由 integrated_workflow.py 统一创建，此处不再重复创建
+    注意: 索引定义以 integrated_workflow.py 为准，此处每个进程仅幂等确认一次，保证 hint 可用
     """
 
     def __init__(self, mongo_url: str, db_name: str = "roza_database"):
@@ -15,6 +23,41 @@ class MongoDBSystem:
         self.db = self.client[db_name]
         self.collection = self.db["user_data"]
 
+        if db_name not in _INDEXED_DBS:
+            self.collection.create_index(_BGU_INDEX, unique=True, name="idx_user_data")
+            _INDEXED_DBS.add(db_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_system(mongo_url: str, db_name: str = "roza_database") -> MongoDBSystem:
+    """按连接参数缓存MongoDBSystem，同一进程内复用同一个MongoClient连接池"""
+    return MongoDBSystem(mongo_url, db_name)
+
+
+def _favor_update_pipeline(new_favor_value: int, favor_change: int) -> List[Dict[str, Any]]:
+    """
+    构建差量更新管道
+    favor_value与last_favor_change均未变化时整条文档保持原样（包括updated_at），
+    服务端识别为空操作，不产生oplog写入
+    """
+    unchanged = {
+        "$and": [
+            {"$eq": ["$favor_value", new_favor_value]},
+            {"$eq": ["$last_favor_change", favor_change]}
+        ]
+    }
+    return [
+        {
+            "$set": {
+                "favor_value": new_favor_value,
+                "last_favor_change": favor_change,
+                "updated_at": {
+                    "$cond": [unchanged, "$updated_at", datetime.utcnow().isoformat()]
+                }
+            }
+        }
+    ]
+
 
 class FavorUpdater:
     """好感度更新器 - 核心业务逻辑"""
@@ -55,30 +98,35 @@ class FavorUpdater:
         return favor_change
     
     def update_favor_single_group(self, bot_id: str, group_id: str, user_id: str,
-                                  new_favor_value: int, favor_change: int) -> Dict[str, Any]:
+                                  new_favor_value: int, favor_change: int,
+                                  allow_upsert: bool = False) -> Dict[str, Any]:
         """
         更新单个群组的好感度
-        
+
+        参数：
+        - allow_upsert: 文档可能不存在时直接upsert；为False时先普通更新，未匹配再退回upsert
+
         返回：
         - matched_count: 匹配的文档数
         - modified_count: 修改的文档数
         """
-        # 更新favor_value和last_favor_change
+        query = {
+            "bot_id": bot_id,
+            "group_id": group_id,
+            "user_id": user_id
+        }
+        pipeline = _favor_update_pipeline(new_favor_value, favor_change)
+
+        # 更新favor_value和last_favor_change（未变化时为空操作）
         result = self.mongo_system.collection.update_one(
-            {
-                "bot_id": bot_id,
-                "group_id": group_id,
-                "user_id": user_id
-            },
-            {
-                "$set": {
-                    "favor_value": new_favor_value,
-                    "last_favor_change": favor_change,
-                    "updated_at": datetime.utcnow().isoformat()
-                }
-            },
-            upsert=True
+            query, pipeline, upsert=allow_upsert, hint=_BGU_INDEX
         )
+
+        # 文档实际不存在时退回upsert创建
+        if result.matched_count == 0 and not allow_upsert:
+            result = self.mongo_system.collection.update_one(
+                query, pipeline, upsert=True, hint=_BGU_INDEX
+            )
         
         return {
             "matched_count": result.matched_count,
@@ -95,19 +143,13 @@ class FavorUpdater:
         - matched_count: 匹配的文档数
         - modified_count: 修改的文档数
         """
-        # 更新所有符合条件的文档（包括9999模板）
+        # 更新所有符合条件的文档（包括9999模板），已是目标值的文档不产生写入
         result = self.mongo_system.collection.update_many(
             {
                 "bot_id": bot_id,
                 "user_id": user_id
             },
-            {
-                "$set": {
-                    "favor_value": new_favor_value,
-                    "last_favor_change": favor_change,
-                    "updated_at": datetime.utcnow().isoformat()
-                }
-            }
+            _favor_update_pipeline(new_favor_value, favor_change)
         )
 
         return {
@@ -146,7 +188,7 @@ def main(
     """
     
     # 初始化系统
-    mongo_system = MongoDBSystem(MONGO_URL)
+    mongo_system = get_system(MONGO_URL)
     favor_updater = FavorUpdater(mongo_system)
     
     # 计算好感度变化
@@ -171,7 +213,9 @@ def main(
             group_id=group_id,
             user_id=user_id,
             new_favor_value=new_favor_value,
-            favor_change=favor_change
+            favor_change=favor_change,
+            # 当前好感度为0时多半还没有记录，直接upsert
+            allow_upsert=favor_value == 0
         )
     
     # 返回结果
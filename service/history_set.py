@@ -1,50 +1,123 @@
 import pymongo
-from datetime import datetime
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.write_concern import WriteConcern
+from datetime import datetime, timezone
+import asyncio
+import functools
 import json
-from typing import Dict, Any, List
+import logging
+import threading
+import types
+from typing import Dict, Any, List, Optional, Tuple, Iterable
+
+logger = logging.getLogger(__name__)
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # pymongo < 4.9 无原生异步API，仅提供同步入口
+    AsyncMongoClient = None
+
+
+def _json_default(value: Any) -> str:
+    """history_entry中的BSON Date时间字段以ISO格式字符串输出"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+try:
+    import orjson
+
+    def _json_dumps(value: Any) -> str:
+        # 与json.dumps一致接受非字符串键（如output中的整数键）
+        return orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:  # orjson 为可选依赖，缺失时退回标准库
+    def _json_dumps(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, default=_json_default)
+
+
+# 进程级MongoClient缓存：按连接URL复用连接池，避免每次调用重新握手与拓扑发现
+_CLIENT_CACHE: Dict[str, pymongo.MongoClient] = {}
+_CLIENT_LOCK = threading.Lock()
+
+
+def _get_client(mongo_url: str) -> pymongo.MongoClient:
+    """获取（必要时创建）指定URL对应的共享MongoClient"""
+    client = _CLIENT_CACHE.get(mongo_url)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _CLIENT_CACHE.get(mongo_url)
+            if client is None:
+                client = pymongo.MongoClient(mongo_url, appname="roza")
+                _CLIENT_CACHE[mongo_url] = client
+    return client
+
+
+# 异步客户端绑定创建它的事件循环，因此按事件循环对象缓存：事件循环 -> {URL: 客户端}
+# 不能用id(loop)作键：asyncio.run 结束后循环被关闭，其id可能被新循环复用；
+# 客户端内部持有循环的强引用，弱引用字典无法自动回收，因此新循环首次获取时清理已关闭循环的条目
+_ASYNC_CLIENT_CACHE: Dict[asyncio.AbstractEventLoop, Dict[str, Any]] = {}
+
+
+def _get_async_client(mongo_url: str) -> Any:
+    """获取（必要时创建）当前事件循环下指定URL对应的共享AsyncMongoClient"""
+    if AsyncMongoClient is None:
+        raise RuntimeError("当前pymongo版本不支持AsyncMongoClient，请升级到4.9以上")
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENT_CACHE.get(loop)
+    if clients is None:
+        for closed in [cached for cached in _ASYNC_CLIENT_CACHE if cached.is_closed()]:
+            del _ASYNC_CLIENT_CACHE[closed]
+        clients = _ASYNC_CLIENT_CACHE[loop] = {}
+    client = clients.get(mongo_url)
+    if client is None:
+        client = clients[mongo_url] = AsyncMongoClient(mongo_url, appname="roza")
+    return client
+
+
+# 历史写入只需主节点确认（w:1），不等待多数派复制，降低副本集部署下的写入尾延迟
+# 代价：主节点在复制前宕机时，最近几轮历史/计数可能随回滚丢失；如需多数派持久化请改回默认写关注
+HISTORY_WRITE_CONCERN = WriteConcern(w=1)
+
+# 历史归档集合：每轮对话一条文档，保存完整历史（user_data中只保留最新窗口）
+HISTORY_COLLECTION = "history_entries"
+# 等值字段在前、排序字段倒序在后，"某用户最近N条"可直接走索引顺序读取
+HISTORY_INDEX_KEYS = [("bot_id", 1), ("group_id", 1), ("user_id", 1), ("created_at", -1)]
+HISTORY_INDEX_NAME = "idx_history_entries"
+
+# 已确认建好归档索引的 (数据库名, 集合名)，每个进程只创建一次，避免热路径上多一次往返
+_INDEXED: set = set()
+_INDEX_LOCK = threading.Lock()
 
 
 class MongoDBSystem:
     """统一的MongoDB系统 - 管理所有数据库操作
 
-    注意: 索引由 integrated_workflow.py 统一创建，此处不再重复创建
+    注意: user_data 的索引由 integrated_workflow.py 统一创建，此处只创建历史归档集合的索引
     """
 
     def __init__(self, mongo_url: str, db_name: str = "roza_database"):
-        self.client = pymongo.MongoClient(mongo_url)
+        self.client = _get_client(mongo_url)
         self.db = self.client[db_name]
-        self.collection = self.db["user_data"]
+        self.collection = self.db.get_collection("user_data", write_concern=HISTORY_WRITE_CONCERN)
+        self.history_collection = self.db.get_collection(HISTORY_COLLECTION, write_concern=HISTORY_WRITE_CONCERN)
+        index_key = (db_name, HISTORY_COLLECTION)
+        if index_key not in _INDEXED:
+            with _INDEX_LOCK:
+                if index_key not in _INDEXED:
+                    self.history_collection.create_index(HISTORY_INDEX_KEYS, name=HISTORY_INDEX_NAME)
+                    _INDEXED.add(index_key)
     
     def get_field(self, bot_id: str, group_id: str, user_id: str, field_name: str) -> Any:
-        """提取指定字段"""
-        document = self.collection.find_one({
-            "bot_id": bot_id,
-            "group_id": group_id,
-            "user_id": user_id
-        })
+        """提取指定字段（只投影该字段，避免拉回整个history_entries数组）"""
+        document = self.collection.find_one(
+            build_user_filter(bot_id, group_id, user_id),
+            projection={field_name: 1, "_id": 0}
+        )
         
         if document:
             return document.get(field_name)
         return None
-    
-    def update_field(self, bot_id: str, group_id: str, user_id: str, field_name: str, new_value: Any) -> Any:
-        """更新指定字段"""
-        result = self.collection.update_one(
-            {
-                "bot_id": bot_id,
-                "group_id": group_id,
-                "user_id": user_id
-            },
-            {
-                "$set": {
-                    field_name: new_value,
-                    "updated_at": datetime.utcnow().isoformat()
-                }
-            },
-            upsert=True
-        )
-        
-        return result
 
 
 class HistoryUpdater:
@@ -53,8 +126,9 @@ class HistoryUpdater:
     def __init__(self, mongo_system: MongoDBSystem):
         self.mongo_system = mongo_system
     
-    def create_history_entry(self, user_name: str, user_query: str, 
-                            output: Dict[str, Any]) -> Dict[str, Any]:
+    @staticmethod
+    def create_history_entry(user_name: str, user_query: str,
+                             output: Dict[str, Any]) -> Dict[str, Any]:
         """
         创建历史会话条目
         
@@ -70,116 +144,228 @@ class HistoryUpdater:
             "user_name": user_name,
             "user_query": user_query,
             "output": output,
-            "created_at": datetime.utcnow().isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
     
-    def update_history(self, bot_id: str, group_id: str, user_id: str,
-                      history_entry: Dict[str, Any]) -> Dict[str, Any]:
+    def update_history(self, user_filter: Dict[str, str],
+                      history_entry: Dict[str, Any],
+                      usage_increments: Dict[str, int],
+                      return_stats: bool = True) -> Dict[str, Any]:
         """
-        更新历史会话池
+        更新历史会话池与total_usage统计（单次原子操作）
+        
+        将新的历史条目追加到history_entries数组（仅保留最新HISTORY_MAX_ENTRIES条），
+        同时写入历史归档集合保存完整记录，
+        并通过$inc累加total_histories与total_usage各计数
         
-        将新的历史条目追加到history_entries数组
-        并更新total_histories统计
+        参数：
+        - user_filter: build_user_filter 构建的用户定位条件（同一轮的各次写入共用）
+        - usage_increments: total_usage各字段的增量（键为不带前缀的字段名）
+        - return_stats: 为False时只写入不读回计数，total_histories与total_usage各字段返回-1
         
         返回：
         - total_histories: 总历史条目数
+        - total_usage: 更新后的total_usage四个字段
         - matched_count: 匹配的文档数
         - modified_count: 修改的文档数
         """
-        # 使用$push将新条目追加到history_entries数组
-        # 使用$inc将total_histories增加1
-        result = self.mongo_system.collection.update_one(
-            {
-                "bot_id": bot_id,
-                "group_id": group_id,
-                "user_id": user_id
-            },
-            {
-                "$push": {
-                    "history_entries": history_entry
-                },
-                "$inc": {
-                    "history_stats.total_histories": 1
-                },
-                "$set": {
-                    "updated_at": datetime.utcnow().isoformat()
-                }
-            },
-            upsert=True
+        if not return_stats:
+            result = self.mongo_system.collection.update_one(
+                user_filter,
+                build_history_update(history_entry, usage_increments),
+                upsert=True
+            )
+            self.mongo_system.history_collection.insert_one(
+                build_archive_document(user_filter, history_entry)
+            )
+            return summarize_unread_update(result, usage_increments)
+
+        # findAndModify一次往返完成写入并返回写入前的计数
+        previous = self.mongo_system.collection.find_one_and_update(
+            user_filter,
+            build_history_update(history_entry, usage_increments),
+            projection=HISTORY_COUNTER_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
         )
-        
-        # 查询更新后的total_histories值
-        document = self.mongo_system.collection.find_one({
-            "bot_id": bot_id,
-            "group_id": group_id,
-            "user_id": user_id
-        })
-        
-        # 获取total_histories
-        if document and "history_stats" in document:
-            total_histories = document["history_stats"].get("total_histories", 1)
-        else:
-            total_histories = 1
-        
-        return {
-            "total_histories": total_histories,
-            "matched_count": result.matched_count,
-            "modified_count": result.modified_count
+        self.mongo_system.history_collection.insert_one(
+            build_archive_document(user_filter, history_entry)
+        )
+        return summarize_history_update(previous, usage_increments)
+
+
+class AsyncHistoryUpdater(HistoryUpdater):
+    """历史会话更新器（异步版本）- 基于AsyncMongoClient，写入逻辑与同步版本一致"""
+
+    def __init__(self, mongo_url: str, db_name: str = "roza_database"):
+        db = _get_async_client(mongo_url)[db_name]
+        self.collection = db.get_collection("user_data", write_concern=HISTORY_WRITE_CONCERN)
+        self.history_collection = db.get_collection(HISTORY_COLLECTION, write_concern=HISTORY_WRITE_CONCERN)
+
+    async def update_history(self, user_filter: Dict[str, str],
+                            history_entry: Dict[str, Any],
+                            usage_increments: Dict[str, int],
+                            return_stats: bool = True) -> Dict[str, Any]:
+        """异步更新历史会话池与total_usage统计，参数与返回值同 HistoryUpdater.update_history"""
+        if not return_stats:
+            result = await self.collection.update_one(
+                user_filter,
+                build_history_update(history_entry, usage_increments),
+                upsert=True
+            )
+            await self.history_collection.insert_one(
+                build_archive_document(user_filter, history_entry)
+            )
+            return summarize_unread_update(result, usage_increments)
+
+        previous = await self.collection.find_one_and_update(
+            user_filter,
+            build_history_update(history_entry, usage_increments),
+            projection=HISTORY_COUNTER_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        await self.history_collection.insert_one(
+            build_archive_document(user_filter, history_entry)
+        )
+        return summarize_history_update(previous, usage_increments)
+
+
+# history_entries保留的最大条数：$push时由服务端用$slice原子截断，限制单文档体积
+# （上下文节点只读取最新context_pool_size条，应保证该值不小于最大的context_pool_size；完整历史见 HISTORY_COLLECTION 归档集合）
+HISTORY_MAX_ENTRIES = 200
+
+# findAndModify只投影计数字段，避免把history_entries数组拉回客户端
+HISTORY_COUNTER_PROJECTION = {"history_stats.total_histories": 1, "total_usage": 1, "_id": 0}
+
+
+@functools.lru_cache(maxsize=4096)
+def build_user_filter(bot_id: str, group_id: str, user_id: str) -> Dict[str, str]:
+    """构建按 (bot_id, group_id, user_id) 定位用户文档的查询条件
+
+    同一用户的连续对话复用同一个字典（有界LRU缓存），返回值为共享对象，调用方不得修改
+    """
+    return {
+        "bot_id": bot_id,
+        "group_id": group_id,
+        "user_id": user_id
+    }
+
+
+def build_archive_document(user_filter: Dict[str, str],
+                           history_entry: Dict[str, Any]) -> Dict[str, Any]:
+    """构建历史归档集合中的单条文档（新建字典，insert_one写入的_id不会回填到history_entry与user_filter）"""
+    return {**user_filter, **history_entry}
+
+
+def build_history_update(history_entry: Dict[str, Any],
+                         usage_increments: Dict[str, int]) -> Dict[str, Any]:
+    """构建追加历史条目并累加计数的更新文档
+
+    history_entries只保留最新的HISTORY_MAX_ENTRIES条；total_histories仍为累计总数
+    updated_at直接复用条目的created_at，同一轮只取一次当前时间
+    $inc作用于不存在的路径时自动创建，与原先的默认值语义一致
+    """
+    inc_fields = {"history_stats.total_histories": 1}
+    for key, value in usage_increments.items():
+        # 增量为0的计数不写入$inc（读取方按缺省0处理），返回值仍由写入前文档推算
+        if value:
+            inc_fields[f"total_usage.{key}"] = value
+    
+    return {
+        "$push": {
+            "history_entries": {
+                "$each": [history_entry],
+                "$slice": -HISTORY_MAX_ENTRIES
+            }
+        },
+        "$inc": inc_fields,
+        "$set": {
+            "updated_at": history_entry["created_at"]
         }
+    }
 
 
-def main(
+# return_stats=False 时计数字段的占位值（未读回计数）
+STATS_NOT_READ = -1
+
+
+def summarize_unread_update(result: Any, usage_increments: Dict[str, int]) -> Dict[str, Any]:
+    """未读回计数时的返回值：计数字段为STATS_NOT_READ，匹配/修改数取自update_one结果"""
+    return {
+        "total_histories": STATS_NOT_READ,
+        "total_usage": {key: STATS_NOT_READ for key in usage_increments},
+        "matched_count": result.matched_count,
+        "modified_count": result.modified_count
+    }
+
+
+def summarize_history_update(previous: Optional[Dict[str, Any]],
+                             usage_increments: Dict[str, int]) -> Dict[str, Any]:
+    """由写入前文档与增量推算写入后的计数
+
+    写入前文档不存在即为upsert插入（与update_one的计数语义一致：匹配0、修改0）
+    """
+    if previous is None:
+        previous = {}
+        matched_count = 0
+        modified_count = 0
+    else:
+        matched_count = 1
+        modified_count = 1
+    
+    previous_usage = previous.get("total_usage")
+    if not isinstance(previous_usage, dict):
+        previous_usage = {}
+    
+    return {
+        "total_histories": previous.get("history_stats", {}).get("total_histories", 0) + 1,
+        "total_usage": {
+            key: previous_usage.get(key, 0) + value
+            for key, value in usage_increments.items()
+        },
+        "matched_count": matched_count,
+        "modified_count": modified_count
+    }
+
+
+# 图片描述写入历史时的上限：最多记录的张数与单条描述的最大长度
+IMAGE_DESC_MAX_COUNT = 20
+IMAGE_DESC_MAX_LENGTH = 500
+
+
+# 错误输出时的返回值模板（跳过写入）：只读，返回给调用方的是副本
+_ERR_RESULT = types.MappingProxyType({
+    "total_histories": 0,  # type: int
+    "history_entry": "{}",  # type: str
+    "matched_count": 0,  # type: int
+    "modified_count": 0,  # type: int
+    "total_chat_count": 0,  # type: int
+    "total_tokens": 0,  # type: int
+    "total_prompt_token": 0,  # type: int
+    "total_output_token": 0  # type: int
+})
+
+
+def _prepare_turn(
     output: Dict[str, Any],
     user_name: str,
     user_query: str,
     image_info: Dict[str, Any],
     error_output: str,
-    bot_id: str,
-    group_id: str,
-    user_id: str,
-    token_usage: Dict[str, Any],
-    MONGO_URL: str
-) -> Dict[str, Any]:
+    token_usage: Dict[str, Any]
+) -> Optional[Tuple[Dict[str, Any], Dict[str, int]]]:
     """
-    历史会话更新主函数
-
-    参数：
-    - output: 输出字典
-    - user_name: 用户名称
-    - user_query: 用户查询内容
-    - image_info: 必填，包含图片描述列表的字典，示例 {"image_info": ["描述1", "描述2"]}
-    - error_output: 错误输出标识
-    - bot_id: 机器人ID
-    - group_id: 群组ID
-    - user_id: 用户ID
-    - token_usage: token使用量字典，包含total_token和prompt_token字段
-    - MONGO_URL: MongoDB连接URL
+    构建本轮的历史条目与total_usage增量（纯计算，不访问数据库）
 
     返回：
-    - total_histories: 总历史条目数
-    - history_entry: 本次创建的历史条目
-    - matched_count: 匹配的文档数量
-    - modified_count: 修改的文档数量
+    - (history_entry, usage_increments)；output为错误输出时返回None
     """
-    
     # 检查output是否为错误输出，避免记录错误结果
     # 假设error_output是一个字符串，而output是字典
     # 如果output中包含错误标识，跳过更新
     if isinstance(output, dict) and output.get("error") == error_output:
-        return {
-            "total_histories": 0,  # type: int
-            "history_entry": "{}",  # type: str
-            "matched_count": 0,  # type: int
-            "modified_count": 0,  # type: int
-            "total_chat_count": 0,  # type: int
-            "total_tokens": 0,  # type: int
-            "total_prompt_token": 0,  # type: int
-            "total_output_token": 0  # type: int
-        }
-    
-    # 初始化系统
-    mongo_system = MongoDBSystem(MONGO_URL)
-    history_updater = HistoryUpdater(mongo_system)
+        return None
 
     # 如果有图片描述列表，按指定格式附加在用户文本后
     user_query_record = user_query
@@ -193,69 +379,48 @@ def main(
 
     if desc_list:
         count = len(desc_list)
-        parts = " ".join([f"第{i + 1}张:{desc}" for i, desc in enumerate(desc_list)])
+        # 只记录前IMAGE_DESC_MAX_COUNT张，单条描述截断到IMAGE_DESC_MAX_LENGTH字，防止异常输入撑大历史条目
+        parts = " ".join(
+            f"第{i}张:{desc[:IMAGE_DESC_MAX_LENGTH]}"
+            for i, desc in enumerate(desc_list[:IMAGE_DESC_MAX_COUNT], 1)
+        )
         user_query_record = f"{user_query}[用户发送了{count}张图片，{parts}]"
     
     # 创建历史条目
-    history_entry = history_updater.create_history_entry(
+    history_entry = HistoryUpdater.create_history_entry(
         user_name=user_name,
         user_query=user_query_record,
         output=output
     )
     
-    # 更新历史会话池
-    update_result = history_updater.update_history(
-        bot_id=bot_id,
-        group_id=group_id,
-        user_id=user_id,
-        history_entry=history_entry
-    )
+    # 提取token使用量（注意字段名是复数形式）
+    # 无token统计（缓存回复、非LLM轮次等）时直接按0处理
+    total_tokens = prompt_tokens = completion_tokens = 0
+    if isinstance(token_usage, dict) and token_usage:
+        try:
+            total_tokens = int(token_usage.get("total_tokens", 0))
+            prompt_tokens = int(token_usage.get("prompt_tokens", 0))
+            completion_tokens = int(token_usage.get("completion_tokens", 0))
+        except (ValueError, TypeError) as e:
+            # 如果token统计解析失败，不影响历史记录的保存
+            logger.warning("Failed to parse token usage statistics: %s", e)
+            total_tokens = prompt_tokens = completion_tokens = 0
     
-    # 提取token使用量并更新total_usage统计
-    new_total_usage = {
-        "total_chat_count": 0,
-        "total_tokens": 0,
-        "total_prompt_token": 0,
-        "total_output_token": 0
+    usage_increments = {
+        "total_chat_count": 1,
+        "total_tokens": total_tokens,
+        "total_prompt_token": prompt_tokens,
+        "total_output_token": completion_tokens
     }
-    
-    try:
-        # 从token_usage提取字段（注意字段名是复数形式）
-        total_tokens = token_usage.get("total_tokens", 0) if isinstance(token_usage, dict) else 0
-        prompt_tokens = token_usage.get("prompt_tokens", 0) if isinstance(token_usage, dict) else 0
-        completion_tokens = token_usage.get("completion_tokens", 0) if isinstance(token_usage, dict) else 0
-        
-        # 获取当前的total_usage
-        current_total_usage = mongo_system.get_field(bot_id, group_id, user_id, "total_usage")
-        
-        # 确保total_usage是字典类型
-        if not isinstance(current_total_usage, dict):
-            current_total_usage = {
-                "total_chat_count": 0,
-                "total_tokens": 0,
-                "total_prompt_token": 0,
-                "total_output_token": 0
-            }
-        
-        # 更新统计
-        new_total_usage = {
-            "total_chat_count": current_total_usage.get("total_chat_count", 0) + 1,
-            "total_tokens": current_total_usage.get("total_tokens", 0) + total_tokens,
-            "total_prompt_token": current_total_usage.get("total_prompt_token", 0) + prompt_tokens,
-            "total_output_token": current_total_usage.get("total_output_token", 0) + completion_tokens
-        }
-
-        # 更新数据库（total_usage各群独立，只更新当前群组）
-        mongo_system.update_field(bot_id, group_id, user_id, "total_usage", new_total_usage)
+    return history_entry, usage_increments
 
-    except Exception as e:
-        # 如果token统计更新失败，不影响历史记录的保存
-        print(f"Warning: Failed to update token usage statistics: {e}")
 
-    # 返回结果（将history_entry转换为JSON字符串，并包含total_usage的四个字段）
+def _build_result(history_entry: Dict[str, Any], update_result: Dict[str, Any]) -> Dict[str, Any]:
+    """组装节点返回值（将history_entry转换为JSON字符串，并包含total_usage的四个字段）"""
+    new_total_usage = update_result["total_usage"]
     return {
         "total_histories": update_result["total_histories"],  # type: int
-        "history_entry": json.dumps(history_entry, ensure_ascii=False),  # type: str
+        "history_entry": _json_dumps(history_entry),  # type: str
         "matched_count": update_result["matched_count"],  # type: int
         "modified_count": update_result["modified_count"],  # type: int
         "total_chat_count": new_total_usage["total_chat_count"],  # type: int
@@ -263,3 +428,173 @@ def main(
         "total_prompt_token": new_total_usage["total_prompt_token"],  # type: int
         "total_output_token": new_total_usage["total_output_token"]  # type: int
     }
+
+
+def main(
+    output: Dict[str, Any],
+    user_name: str,
+    user_query: str,
+    image_info: Dict[str, Any],
+    error_output: str,
+    bot_id: str,
+    group_id: str,
+    user_id: str,
+    token_usage: Dict[str, Any],
+    MONGO_URL: str,
+    return_stats: bool = True
+) -> Dict[str, Any]:
+    """
+    历史会话更新主函数
+
+    参数：
+    - output: 输出字典
+    - user_name: 用户名称
+    - user_query: 用户查询内容
+    - image_info: 必填，包含图片描述列表的字典，示例 {"image_info": ["描述1", "描述2"]}
+    - error_output: 错误输出标识
+    - bot_id: 机器人ID
+    - group_id: 群组ID
+    - user_id: 用户ID
+    - token_usage: token使用量字典，包含total_token和prompt_token字段
+    - MONGO_URL: MongoDB连接URL
+    - return_stats: 是否读回计数；为False时省去计数读取，
+      total_histories与total_*字段返回-1（STATS_NOT_READ）
+
+    返回：
+    - total_histories: 总历史条目数
+    - history_entry: 本次创建的历史条目
+    - matched_count: 匹配的文档数量
+    - modified_count: 修改的文档数量
+    """
+    turn = _prepare_turn(output, user_name, user_query, image_info, error_output, token_usage)
+    if turn is None:
+        return dict(_ERR_RESULT)
+    history_entry, usage_increments = turn
+
+    # 更新历史会话池，同时累加total_usage（total_usage各群独立，只更新当前群组）
+    history_updater = HistoryUpdater(MongoDBSystem(MONGO_URL))
+    update_result = history_updater.update_history(
+        user_filter=build_user_filter(bot_id, group_id, user_id),
+        history_entry=history_entry,
+        usage_increments=usage_increments,
+        return_stats=return_stats
+    )
+    return _build_result(history_entry, update_result)
+
+
+def main_batch(items: List[Dict[str, Any]], MONGO_URL: str) -> List[Dict[str, Any]]:
+    """
+    批量历史会话更新（队列/批处理消费场景）
+
+    参数：
+    - items: 每项为 main 除 MONGO_URL 外的全部参数组成的字典
+    - MONGO_URL: MongoDB连接URL
+
+    返回：
+    - 与items一一对应的结果列表，字段同 main
+      同一用户在一批中出现多次时，各项的计数均为整批写入后的最终值
+
+    所有写入通过一次无序bulk_write提交（服务端可并行执行），
+    写入后用一次$or查询取回全部用户的计数
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    pending: List[Tuple[int, Dict[str, str], Dict[str, Any], Dict[str, int]]] = []
+    for index, item in enumerate(items):
+        turn = _prepare_turn(
+            item.get("output"), item.get("user_name"), item.get("user_query"),
+            item.get("image_info"), item.get("error_output"), item.get("token_usage")
+        )
+        if turn is None:
+            results[index] = dict(_ERR_RESULT)
+            continue
+        history_entry, usage_increments = turn
+        user_filter = build_user_filter(item.get("bot_id"), item.get("group_id"), item.get("user_id"))
+        pending.append((index, user_filter, history_entry, usage_increments))
+
+    if pending:
+        mongo_system = MongoDBSystem(MONGO_URL)
+        bulk_result = mongo_system.collection.bulk_write(
+            [
+                UpdateOne(user_filter, build_history_update(history_entry, usage_increments), upsert=True)
+                for _, user_filter, history_entry, usage_increments in pending
+            ],
+            ordered=False
+        )
+        mongo_system.history_collection.insert_many(
+            [
+                build_archive_document(user_filter, history_entry)
+                for _, user_filter, history_entry, _ in pending
+            ],
+            ordered=False
+        )
+
+        post_images = _find_counters(mongo_system, (user_filter for _, user_filter, _, _ in pending))
+        upserted = bulk_result.upserted_ids
+        for op_index, (index, user_filter, history_entry, usage_increments) in enumerate(pending):
+            document = post_images.get(
+                (user_filter["bot_id"], user_filter["group_id"], user_filter["user_id"]), {}
+            )
+            usage = document.get("total_usage")
+            if not isinstance(usage, dict):
+                usage = {}
+            written = 0 if op_index in upserted else 1
+            results[index] = _build_result(history_entry, {
+                "total_histories": document.get("history_stats", {}).get("total_histories", 0),
+                "total_usage": {key: usage.get(key, 0) for key in usage_increments},
+                "matched_count": written,
+                "modified_count": written
+            })
+
+    return results
+
+
+def _find_counters(mongo_system: MongoDBSystem,
+                   user_filters: Iterable[Dict[str, str]]) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
+    """一次$or查询取回多个用户的计数字段，按 (bot_id, group_id, user_id) 索引"""
+    unique_filters = {
+        (f["bot_id"], f["group_id"], f["user_id"]): f for f in user_filters
+    }
+    cursor = mongo_system.collection.find(
+        {"$or": list(unique_filters.values())},
+        projection={
+            "bot_id": 1, "group_id": 1, "user_id": 1,
+            "history_stats.total_histories": 1, "total_usage": 1, "_id": 0
+        }
+    )
+    return {
+        (doc.get("bot_id"), doc.get("group_id"), doc.get("user_id")): doc
+        for doc in cursor
+    }
+
+
+async def main_async(
+    output: Dict[str, Any],
+    user_name: str,
+    user_query: str,
+    image_info: Dict[str, Any],
+    error_output: str,
+    bot_id: str,
+    group_id: str,
+    user_id: str,
+    token_usage: Dict[str, Any],
+    MONGO_URL: str,
+    return_stats: bool = True
+) -> Dict[str, Any]:
+    """
+    历史会话更新主函数（异步版本）
+
+    供运行在事件循环中的调用方使用，参数与返回值同 main；
+    数据库写入通过AsyncMongoClient完成，不阻塞事件循环
+    """
+    turn = _prepare_turn(output, user_name, user_query, image_info, error_output, token_usage)
+    if turn is None:
+        return dict(_ERR_RESULT)
+    history_entry, usage_increments = turn
+
+    update_result = await AsyncHistoryUpdater(MONGO_URL).update_history(
+        user_filter=build_user_filter(bot_id, group_id, user_id),
+        history_entry=history_entry,
+        usage_increments=usage_increments,
+        return_stats=return_stats
+    )
+    return _build_result(history_entry, update_result)
@@ -1,11 +1,328 @@
 import pymongo
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
 from datetime import datetime
 import re
 import json
 import math
 import random
-from collections import Counter
-from typing import Dict, Any, Optional, Tuple, List, Union
+import asyncio
+import bisect
+import contextvars
+import copy
+import functools
+import heapq
+import importlib.util
+import threading
+import time
+import types
+from collections import Counter, OrderedDict
+from typing import Dict, Any, Generator, Optional, Tuple, List, Union
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时退回标准库
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy 为可选依赖，缺失时记忆检索使用纯Python计算
+    np = None
+
+try:
+    import simsimd
+except ImportError:  # simsimd 为可选依赖，缺失时向量余弦由numpy/纯Python计算
+    simsimd = None
+
+try:
+    import numba
+except ImportError:  # numba 为可选依赖，缺失时大规模向量余弦同样由numpy计算
+    numba = None
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # pymongo < 4.9 无原生异步API，仅提供同步入口
+    AsyncMongoClient = None
+
+
+@functools.lru_cache(maxsize=1024)
+def _iso_to_timestamp(value: str) -> Optional[float]:
+    """解析ISO格式时间字符串为时间戳（突发流量下同一时间串会被反复解析，结果缓存），无法解析时返回None"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+def _date_value(value: Any) -> Optional[int]:
+    """从BSON Date或ISO格式字符串中取出YYYYMMDD整数日期，无法识别时返回None"""
+    if isinstance(value, str):
+        # ISO日期按字典序排列在最前，直接截取前10位：2023-12-26T14:37:11 -> 20231226
+        digits = value[:10].replace('-', '')
+        if len(value) >= 10 and len(digits) == 8 and digits.isdigit():
+            return int(digits)
+        return None
+    if isinstance(value, datetime):
+        return value.year * 10000 + value.month * 100 + value.day
+    return None
+
+
+# 默认字段模板（只读）；各 _get_default_* 返回浅拷贝，值均为不可变类型
+_DEFAULT_PERSONA_ATTRIBUTES = types.MappingProxyType({
+    "basic_info": "",
+    "living_habits": "",
+    "psychological_traits": "",
+    "interests_preferences": "",
+    "dislikes": "",
+    "ai_expectations": "",
+    "memory_points": "",
+})
+# 画像字段在提示词中的显示顺序与名称
+_PERSONA_LABELS = (
+    ("basic_info", "基本信息"),
+    ("living_habits", "生活习惯"),
+    ("psychological_traits", "心理特征"),
+    ("interests_preferences", "兴趣偏好"),
+    ("dislikes", "反感点"),
+    ("ai_expectations", "对AI的期望"),
+    ("memory_points", "希望记住的信息"),
+)
+_DEFAULT_BLOCK_STATS = types.MappingProxyType({
+    "block_status": True,  # True=pass, False=block
+    "block_count": 0,
+})
+_DEFAULT_TOTAL_USAGE = types.MappingProxyType({
+    "total_chat_count": 0,
+    "total_tokens": 0,
+    "total_prompt_token": 0,
+    "total_output_token": 0
+})
+
+# 进程内用户字段缓存：(db_name, bot_id, group_id, user_id) -> {字段名: (过期时间, 值)}
+# 按用户LRU淘汰，本节点写入时整条失效；其他节点（favor_set、history_set等）的写入无法通知到这里，
+# 因此默认关闭（cache_ttl=0），开启时TTL即为可容忍的跨节点数据延迟
+_FIELD_CACHE: "OrderedDict[Tuple[str, str, str, str], Dict[str, Tuple[float, Any]]]" = OrderedDict()
+_FIELD_CACHE_MAX_USERS = 50000
+_FIELD_CACHE_LOCK = threading.RLock()
+
+# 9999模板缓存：(db_name, bot_id, user_id) -> (过期时间, 模板文档)，与字段缓存共用开关与有效期（cache_ttl）
+# 同一用户陆续进入多个新群时只查询一次模板；本节点写入模板时失效，其他节点的写入在TTL内不可见
+_TEMPLATE_CACHE: "OrderedDict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_TEMPLATE_CACHE_MAX_USERS = 50000
+
+# 继承只用到模板中的这些字段，查询模板时只取回它们
+_TEMPLATE_PROJECTION = {
+    "block_stats": 1,
+    "favor_value": 1,
+    "last_favor_change": 1,
+    "persona_attributes": 1,
+    "daily_usage_count": 1,
+    "_id": 0,
+}
+
+# user_data 集合的索引：
+# idx_user_data 为 (bot_id, group_id, user_id) 唯一索引，同时覆盖9999模板的等值查询；
+# idx_bot_user 服务于新建文档时"同一用户除当前群组外的文档（模板优先）"聚合查询（group_id为$ne条件，无法利用前者的前缀）
+USER_DATA_INDEXES = (
+    ([("bot_id", 1), ("group_id", 1), ("user_id", 1)], {"unique": True, "name": "idx_user_data"}),
+    ([("bot_id", 1), ("user_id", 1)], {"name": "idx_bot_user"}),
+)
+
+# 已确认建好索引的 (数据库名, 集合名)，每个进程只创建一次，避免热路径上多一次往返
+_INDEXED: set = set()
+_INDEX_LOCK = threading.Lock()
+
+# 线协议压缩：zstd/snappy需要可选模块zstandard/python-snappy，只列出已安装的，zlib始终可用
+_COMPRESSORS = ",".join(
+    [name for name, module in (("zstd", "zstandard"), ("snappy", "snappy"))
+     if importlib.util.find_spec(module) is not None] + ["zlib"]
+)
+
+# MongoClient 公共参数：history_entries/long_term_memory 等数组字段压缩后传输量明显下降；
+# 用户数据写入只需主节点确认（w:1），与 history_set.py 一致；读取仍走主节点，保证 _v 版本校验读到最新值
+_CLIENT_OPTIONS = {
+    "appname": "roza",
+    "compressors": _COMPRESSORS,
+    "zlibCompressionLevel": 6,
+    "maxPoolSize": 200,
+    "retryWrites": True,
+    "w": 1,
+}
+
+# 进程级MongoClient缓存：按连接URL复用连接池，避免每次调用重新握手与拓扑发现
+_CLIENT_CACHE: Dict[str, pymongo.MongoClient] = {}
+_CLIENT_LOCK = threading.Lock()
+
+
+def _get_client(mongo_url: str) -> pymongo.MongoClient:
+    """获取（必要时创建）指定URL对应的共享MongoClient"""
+    client = _CLIENT_CACHE.get(mongo_url)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _CLIENT_CACHE.get(mongo_url)
+            if client is None:
+                client = pymongo.MongoClient(mongo_url, **_CLIENT_OPTIONS)
+                _CLIENT_CACHE[mongo_url] = client
+    return client
+
+
+# 异步客户端绑定创建它的事件循环，因此按事件循环对象缓存：事件循环 -> {URL: 客户端}
+# 不能用id(loop)作键：asyncio.run 结束后循环被关闭，其id可能被新循环复用；
+# 客户端内部持有循环的强引用，弱引用字典无法自动回收，因此新循环首次获取时清理已关闭循环的条目
+_ASYNC_CLIENT_CACHE: Dict[asyncio.AbstractEventLoop, Dict[str, Any]] = {}
+
+
+def _get_async_client(mongo_url: str) -> Any:
+    """获取（必要时创建）当前事件循环下指定URL对应的共享AsyncMongoClient"""
+    if AsyncMongoClient is None:
+        raise RuntimeError("当前pymongo版本不支持AsyncMongoClient，请升级到4.9以上")
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENT_CACHE.get(loop)
+    if clients is None:
+        for closed in [cached for cached in _ASYNC_CLIENT_CACHE if cached.is_closed()]:
+            del _ASYNC_CLIENT_CACHE[closed]
+        clients = _ASYNC_CLIENT_CACHE[loop] = {}
+    client = clients.get(mongo_url)
+    if client is None:
+        client = clients[mongo_url] = AsyncMongoClient(mongo_url, **_CLIENT_OPTIONS)
+    return client
+
+
+# 管道更新中从updated_at取出YYYYMMDD日期串（BSON Date或ISO格式字符串，其他情况视为19700101）
+_USAGE_LAST_DATE_EXPR = {
+    "$switch": {
+        "branches": [
+            {
+                "case": {"$eq": [{"$type": "$updated_at"}, "date"]},
+                "then": {"$dateToString": {"date": "$updated_at", "format": "%Y%m%d"}}
+            },
+            {
+                "case": {"$eq": [{"$type": "$updated_at"}, "string"]},
+                "then": {"$concat": [
+                    {"$substrCP": ["$updated_at", 0, 4]},
+                    {"$substrCP": ["$updated_at", 5, 2]},
+                    {"$substrCP": ["$updated_at", 8, 2]}
+                ]}
+            }
+        ],
+        "default": "19700101"
+    }
+}
+_USAGE_COUNT_EXPR = {"$convert": {"input": "$daily_usage_count", "to": "int", "onError": 0, "onNull": 0}}
+
+# 请求写入提交的最大尝试次数：提交以读取时的 _v 为条件，冲突时用新读取的文档重新执行各步骤；
+# 最后一次不再校验版本，退回为直接覆盖
+REQUEST_MAX_ATTEMPTS = 3
+
+# 跨群配置的默认值：(好感度, 用户画像, 黑名单, 用量统计) 均不跨群
+_NO_CROSS_GROUP = (False, False, False, False)
+
+
+class ChatRequestContext:
+    """
+    单次对话请求的读写快照
+
+    请求开始时一次投影读取各步骤需要的字段，之后对同一用户的读取直接使用快照；
+    各管理器的字段写入暂存在 pending 中（数组元素的计数自增暂存在 increments 中），请求结束时合并为一次写入
+    """
+
+    def __init__(self, bot_id: str, group_id: str, user_id: str,
+                 fields: Tuple[str, ...], document: Dict[str, Any], history_count: int):
+        self.key = (bot_id, group_id, user_id)
+        self.fields = frozenset(fields)
+        self.document = document
+        # 读取时的文档版本，提交写入时作为条件（旧文档没有 _v，为None）
+        self.version = document.get("_v")
+        self.history_count = history_count
+        self.pending: Dict[str, Any] = {}
+        self.increments: Dict[str, int] = {}
+
+    def covers(self, fields: Tuple[str, ...]) -> bool:
+        """快照是否包含所需的全部字段"""
+        return all(field in self.fields for field in fields)
+
+    def read(self, fields: Tuple[str, ...]) -> Dict[str, Any]:
+        """读取字段，本次请求已写入的值优先"""
+        result = {}
+        for field in fields:
+            if field in self.pending:
+                result[field] = self.pending[field]
+            elif field in self.document:
+                result[field] = self.document[field]
+        return result
+
+    @staticmethod
+    def projection(fields: Tuple[str, ...], history_count: int) -> Dict[str, Any]:
+        """请求开始时的读取投影：所需字段加上服务端$slice截取的最新history_count条历史"""
+        projection: Dict[str, Any] = {field: 1 for field in fields}
+        if history_count > 0:
+            projection["history_entries"] = {"$slice": -history_count}
+        projection["_v"] = 1
+        projection["_id"] = 0
+        return projection
+
+    def update_operations(self, check_version: bool = True) -> List[UpdateOne]:
+        """
+        把本次请求暂存的写入合并为UpdateOne列表（通常只有一条），没有写入时返回空列表
+
+        check_version=True 时只在文档版本仍为读取时的 _v 才写入（请求开始时已确保文档存在，不再upsert）；
+        数组元素的点路径写入（如 long_term_memory.3.hit_count）要求对应下标仍存在，
+        否则数组在请求期间被清空/缩短（如 /Roza.clear.memory）后，写入会把数组补齐为null
+        """
+        if not self.pending and not self.increments:
+            return []
+        bot_id, group_id, user_id = self.key
+        query = {
+            "bot_id": bot_id,
+            "group_id": group_id,
+            "user_id": user_id
+        }
+        # 整个字段已被整体写入时，其下的点路径写入/自增已体现在快照值中，不再单独提交（否则路径冲突）
+        pending = self.pending
+        updates = {path: value for path, value in pending.items()
+                   if "." not in path or path.split(".", 1)[0] not in pending}
+        increments = {path: amount for path, amount in self.increments.items()
+                      if path.split(".", 1)[0] not in pending}
+
+        # 数组元素写入的存在性条件：每个数组字段只需检查最大下标
+        max_index: Dict[str, int] = {}
+        element_paths = set()
+        for path in (*updates, *increments):
+            parts = path.split(".", 2)
+            if len(parts) > 1 and parts[1].isdecimal():
+                max_index[parts[0]] = max(max_index.get(parts[0], -1), int(parts[1]))
+                element_paths.add(path)
+        guards = {f"{field}.{idx}": {"$exists": True} for field, idx in max_index.items()}
+
+        element_updates: Dict[str, Any] = {}
+        element_increments: Dict[str, int] = {}
+        if check_version:
+            # 条件不满足时与版本冲突同样处理：提交失败，由调用方重新读取后重试
+            query.update(guards)
+            query["_v"] = self.version
+        elif guards:
+            # 不校验版本的提交会upsert，不能带存在性条件；数组元素写入拆成单独一条带条件的更新，
+            # 数组已变化时只丢弃这部分写入，其他字段照常提交
+            element_updates = {path: updates.pop(path) for path in element_paths if path in updates}
+            element_increments = {path: increments.pop(path) for path in element_paths if path in increments}
+
+        increments["_v"] = 1
+        operation: Dict[str, Any] = {
+            "$inc": increments,
+            "$currentDate": {"updated_at": True}
+        }
+        if updates:
+            operation["$set"] = updates
+        operations = [UpdateOne(query, operation, upsert=not check_version)]
+
+        if element_updates or element_increments:
+            element_operation: Dict[str, Any] = {}
+            if element_updates:
+                element_operation["$set"] = element_updates
+            if element_increments:
+                element_operation["$inc"] = element_increments
+            operations.append(UpdateOne({**query, **guards}, element_operation))
+        return operations
 
 
 class MongoDBSystem:
@@ -13,24 +330,64 @@ class MongoDBSystem:
 
     # 模板文档的group_id常量
     TEMPLATE_GROUP_ID = "9999"
+    # 是否支持服务端记忆向量检索（见 search_memories_by_embedding）；支持时请求开始时不预取记忆数组
+    # 服务端不支持所需的聚合操作符（MongoDB < 5.2）时，首次检索失败后在该实例上关闭
+    SERVER_MEMORY_SEARCH = True
 
-    def __init__(self, mongo_url: str, db_name: str = "roza_database"):
-        self.client = pymongo.MongoClient(mongo_url)
+    def __init__(self, mongo_url: str, db_name: str = "roza_database", cache_ttl: float = 0):
+        self.client = _get_client(mongo_url)
+        self.db_name = db_name
         self.db = self.client[db_name]
         self.collection = self.db["user_data"]
+        # 字段缓存有效期（秒），0表示不使用缓存
+        self.cache_ttl = cache_ttl
+        self._init_call_state()
+
+        # 创建索引，确保快速查询（每个进程只创建一次）
+        index_key = (db_name, "user_data")
+        if index_key not in _INDEXED:
+            with _INDEX_LOCK:
+                if index_key not in _INDEXED:
+                    for keys, options in USER_DATA_INDEXES:
+                        self.collection.create_index(keys, **options)
+                    _INDEXED.add(index_key)
+
+    def _init_call_state(self):
+        """
+        初始化按调用隔离的状态：当前请求的读写快照（见 begin_request/flush_request）与跨群配置
+
+        实例在进程内复用（见 _get_workflow），并发的线程/协程各自持有一份，互不覆盖
+        """
+        self._request_state: contextvars.ContextVar = contextvars.ContextVar(
+            f"roza_request_{id(self)}", default=None
+        )
+        self._cross_group_state: contextvars.ContextVar = contextvars.ContextVar(
+            f"roza_cross_group_{id(self)}", default=_NO_CROSS_GROUP
+        )
+
+    @property
+    def _request(self) -> Optional[ChatRequestContext]:
+        return self._request_state.get()
+
+    @_request.setter
+    def _request(self, request: Optional[ChatRequestContext]):
+        self._request_state.set(request)
+
+    @property
+    def _favor_cross_group(self) -> bool:
+        return self._cross_group_state.get()[0]
+
+    @property
+    def _persona_cross_group(self) -> bool:
+        return self._cross_group_state.get()[1]
 
-        # 创建复合索引，确保快速查询
-        self.collection.create_index([
-            ("bot_id", 1),
-            ("group_id", 1),
-            ("user_id", 1)
-        ], unique=True, name="idx_user_data")
+    @property
+    def _blacklist_cross_group(self) -> bool:
+        return self._cross_group_state.get()[2]
 
-        # 跨群配置（默认值，使用布尔类型）
-        self._favor_cross_group: bool = False
-        self._persona_cross_group: bool = False
-        self._blacklist_cross_group: bool = False
-        self._usage_limit_cross_group: bool = False
+    @property
+    def _usage_limit_cross_group(self) -> bool:
+        return self._cross_group_state.get()[3]
 
     def set_cross_group_config(self, favor_cross_group: Any = False,
                                persona_cross_group: Any = False,
@@ -45,40 +402,220 @@ class MongoDBSystem:
             blacklist_cross_group: 黑名单是否跨群
             usage_limit_cross_group: 用量统计是否跨群
         """
-        self._favor_cross_group = bool(favor_cross_group)
-        self._persona_cross_group = bool(persona_cross_group)
-        self._blacklist_cross_group = bool(blacklist_cross_group)
-        self._usage_limit_cross_group = bool(usage_limit_cross_group)
+        self._cross_group_state.set((
+            bool(favor_cross_group),
+            bool(persona_cross_group),
+            bool(blacklist_cross_group),
+            bool(usage_limit_cross_group)
+        ))
 
     def _get_default_persona_attributes(self) -> Dict[str, str]:
         """获取默认的用户画像属性"""
-        return {
-            "basic_info": "",
-            "living_habits": "",
-            "psychological_traits": "",
-            "interests_preferences": "",
-            "dislikes": "",
-            "ai_expectations": "",
-            "memory_points": "",
-        }
+        return dict(_DEFAULT_PERSONA_ATTRIBUTES)
 
     def _get_default_block_stats(self) -> Dict[str, Any]:
         """获取默认的黑名单状态"""
-        current_time = datetime.utcnow()
-        return {
-            "block_status": True,  # True=pass, False=block
-            "block_count": 0,
-            "last_operate_time": current_time.isoformat()
-        }
+        return {**_DEFAULT_BLOCK_STATS, "last_operate_time": datetime.utcnow().isoformat()}
 
     def _get_default_total_usage(self) -> Dict[str, int]:
         """获取默认的总使用量统计"""
-        return {
-            "total_chat_count": 0,
-            "total_tokens": 0,
-            "total_prompt_token": 0,
-            "total_output_token": 0
+        return dict(_DEFAULT_TOTAL_USAGE)
+
+    def _cache_get(self, bot_id: str, group_id: str, user_id: str,
+                   fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        """从字段缓存读取，所有字段均命中且未过期时返回副本，否则返回None"""
+        if self.cache_ttl <= 0:
+            return None
+        key = (self.db_name, bot_id, group_id, user_id)
+        now = time.monotonic()
+        with _FIELD_CACHE_LOCK:
+            entry = _FIELD_CACHE.get(key)
+            if entry is None:
+                return None
+            result = {}
+            for field in fields:
+                cached = entry.get(field)
+                if cached is None or cached[0] <= now:
+                    return None
+                result[field] = cached[1]
+            _FIELD_CACHE.move_to_end(key)
+        # 调用方可能原地修改字典/列表字段，返回深拷贝
+        return copy.deepcopy(result)
+
+    def _cache_put(self, bot_id: str, group_id: str, user_id: str,
+                   fields: Tuple[str, ...], document: Dict[str, Any]):
+        """把查询结果写入字段缓存（文档中缺失的字段不缓存）"""
+        if self.cache_ttl <= 0:
+            return
+        key = (self.db_name, bot_id, group_id, user_id)
+        expires_at = time.monotonic() + self.cache_ttl
+        values = {field: (expires_at, copy.deepcopy(document[field])) for field in fields if field in document}
+        with _FIELD_CACHE_LOCK:
+            entry = _FIELD_CACHE.get(key)
+            if entry is None:
+                entry = _FIELD_CACHE[key] = {}
+            entry.update(values)
+            _FIELD_CACHE.move_to_end(key)
+            while len(_FIELD_CACHE) > _FIELD_CACHE_MAX_USERS:
+                _FIELD_CACHE.popitem(last=False)
+
+    def _cache_invalidate(self, bot_id: str, group_id: str, user_id: str):
+        """本节点写入用户文档后，丢弃该用户的全部缓存字段（写入9999模板时同时丢弃模板缓存）"""
+        if self.cache_ttl <= 0:
+            return
+        with _FIELD_CACHE_LOCK:
+            _FIELD_CACHE.pop((self.db_name, bot_id, group_id, user_id), None)
+            if group_id == self.TEMPLATE_GROUP_ID:
+                _TEMPLATE_CACHE.pop((self.db_name, bot_id, user_id), None)
+
+    def _template_cache_get(self, bot_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """从模板缓存读取未过期的9999模板，未命中返回None"""
+        if self.cache_ttl <= 0:
+            return None
+        key = (self.db_name, bot_id, user_id)
+        with _FIELD_CACHE_LOCK:
+            cached = _TEMPLATE_CACHE.get(key)
+            if cached is None or cached[0] <= time.monotonic():
+                return None
+            _TEMPLATE_CACHE.move_to_end(key)
+        return copy.deepcopy(cached[1])
+
+    def _template_cache_put(self, bot_id: str, user_id: str, template_doc: Optional[Dict[str, Any]]):
+        """缓存9999模板（不存在的模板不缓存）"""
+        if self.cache_ttl <= 0 or not template_doc:
+            return
+        key = (self.db_name, bot_id, user_id)
+        value = (time.monotonic() + self.cache_ttl, copy.deepcopy(template_doc))
+        with _FIELD_CACHE_LOCK:
+            _TEMPLATE_CACHE[key] = value
+            _TEMPLATE_CACHE.move_to_end(key)
+            while len(_TEMPLATE_CACHE) > _TEMPLATE_CACHE_MAX_USERS:
+                _TEMPLATE_CACHE.popitem(last=False)
+
+    def begin_request(self, bot_id: str, group_id: str, user_id: str,
+                      fields: Tuple[str, ...], history_count: int = 0,
+                      refresh: bool = False):
+        """
+        开始一次对话请求：一次往返读取本次请求需要的全部字段（history_entries由服务端$slice截取）
+
+        之后该用户的 get_projected/get_recent_history 直接读快照，写入暂存到 flush_request 时统一提交；
+        fields 为空且 history_count<=0 时不查询数据库；refresh=True 时不使用字段缓存（版本冲突后重新读取）
+        """
+        self._request = None
+        if not fields and history_count <= 0:
+            return
+
+        # 版本号随字段一起缓存，命中缓存时同样能以 _v 为条件提交
+        cache_fields = fields + ("_v",)
+        document = None
+        if history_count <= 0 and not refresh:
+            document = self._cache_get(bot_id, group_id, user_id, cache_fields)
+        if document is None:
+            document, created = self._find_or_create(
+                bot_id, group_id, user_id, ChatRequestContext.projection(fields, history_count)
+            )
+            if created and history_count > 0:
+                # 新建文档未经过服务端投影，这里同样只保留最新history_count条
+                document["history_entries"] = document["history_entries"][-history_count:]
+            self._cache_put(bot_id, group_id, user_id, cache_fields, document)
+
+        self._request = ChatRequestContext(bot_id, group_id, user_id, fields, document, history_count)
+
+    def _request_for(self, bot_id: str, group_id: str, user_id: str) -> Optional[ChatRequestContext]:
+        """返回该用户当前进行中的请求快照，没有时返回None"""
+        request = self._request
+        if request is not None and request.key == (bot_id, group_id, user_id):
+            return request
+        return None
+
+    def flush_request(self, check_version: bool = True) -> bool:
+        """
+        结束当前请求：把暂存的字段写入合并为一次bulk_write提交，没有写入时不访问数据库
+
+        返回：是否已提交（check_version=True 且文档在读取后被其他请求修改过时返回False，写入被丢弃）
+        """
+        request, self._request = self._request, None
+        operations = request.update_operations(check_version) if request is not None else []
+        if not operations:
+            return True
+        result = self.apply_updates(operations)
+        self._cache_invalidate(*request.key)
+        return not check_version or result.matched_count > 0
+
+    def in_request(self, bot_id: str, group_id: str, user_id: str) -> bool:
+        """该用户是否有进行中的请求快照（此时读写均落在快照上，由 flush_request 统一提交）"""
+        return self._request_for(bot_id, group_id, user_id) is not None
+
+    def increment_daily_usage(self, bot_id: str, group_id: str, user_id: str,
+                              current_date: str, usage_limit: int) -> Dict[str, Any]:
+        """
+        用一条管道更新原子地完成每日用量的跨天重置/自增，判断规则同 UsageLimitManager：
+        跨天重置为1；同一天且计数不超过usage_limit时加1；其余情况（超限、日期异常）文档保持不变
+
+        返回：更新前的 daily_usage_count/updated_at（调用方据此得到与服务端一致的判断结果）
+        """
+        query = {
+            "bot_id": bot_id,
+            "group_id": group_id,
+            "user_id": user_id
         }
+        new_day = {"$gt": [current_date, _USAGE_LAST_DATE_EXPR]}
+        same_day_allowed = {"$and": [
+            {"$eq": [current_date, _USAGE_LAST_DATE_EXPR]},
+            {"$lte": [_USAGE_COUNT_EXPR, usage_limit]}
+        ]}
+        accepted = {"$or": [new_day, same_day_allowed]}
+        pipeline = [{"$set": {
+            "daily_usage_count": {"$cond": [
+                new_day, 1,
+                {"$cond": [same_day_allowed, {"$add": [_USAGE_COUNT_EXPR, 1]}, "$daily_usage_count"]}
+            ]},
+            "updated_at": {"$cond": [accepted, "$$NOW", "$updated_at"]},
+            # 同步推进版本号，让并发请求的快照提交能感知到这次计数
+            "_v": {"$cond": [accepted, {"$add": [{"$ifNull": ["$_v", 0]}, 1]}, "$_v"]},
+        }}]
+        projection = {"daily_usage_count": 1, "updated_at": 1, "_id": 0}
+
+        previous = self.collection.find_one_and_update(
+            query, pipeline, projection=projection, return_document=ReturnDocument.BEFORE
+        )
+        if previous is None:
+            # 文档不存在：按常规流程创建（含模板继承）后再执行一次
+            self._find_or_create(bot_id, group_id, user_id, projection)
+            previous = self.collection.find_one_and_update(
+                query, pipeline, projection=projection, return_document=ReturnDocument.BEFORE
+            ) or {}
+        self._cache_invalidate(bot_id, group_id, user_id)
+        return previous
+
+    def cas_update(self, bot_id: str, group_id: str, user_id: str,
+                   version: Optional[int], updates: Dict[str, Any]) -> bool:
+        """
+        以文档版本为条件写入字段（乐观并发）：仅当 _v 仍为 version 时写入并把 _v 加1
+
+        返回：是否写入成功；False表示文档已被其他请求修改，调用方应重新读取后重试
+        """
+        result = self.collection.update_one(
+            {
+                "bot_id": bot_id,
+                "group_id": group_id,
+                "user_id": user_id,
+                "_v": version
+            },
+            {
+                "$set": updates,
+                "$inc": {"_v": 1},
+                "$currentDate": {"updated_at": True}
+            }
+        )
+        self._cache_invalidate(bot_id, group_id, user_id)
+        return result.matched_count > 0
+
+    def apply_updates(self, operations: List[Any]) -> Any:
+        """以一次无序 bulk_write 提交多条写操作，operations 为空时不访问数据库"""
+        if not operations:
+            return None
+        return self.collection.bulk_write(operations, ordered=False)
 
     def get_document(self, bot_id: str, group_id: str, user_id: str) -> Dict[str, Any]:
         """
@@ -94,83 +631,201 @@ class MongoDBSystem:
 
         返回：用户文档字典
         """
-        # 步骤1：尝试读取当前群组文档
-        document = self.collection.find_one({
-            "bot_id": bot_id,
-            "group_id": group_id,
-            "user_id": user_id
-        })
+        return self.get_projected(bot_id, group_id, user_id)
 
-        # 如果文档存在，直接返回
-        if document:
+    def get_projected(self, bot_id: str, group_id: str, user_id: str,
+                      fields: Optional[Tuple[str, ...]] = None) -> Dict[str, Any]:
+        """
+        获取用户文档中的指定字段，如果文档不存在则先创建默认文档（逻辑同 get_document）
+
+        只取回需要的字段，避免为读取一个小字段而传输整个history_entries/long_term_memory
+
+        参数：
+            bot_id: 机器人ID
+            group_id: 群组ID
+            user_id: 用户ID
+            fields: 需要的字段名元组，None表示整个文档
+
+        返回：只包含所需字段的文档字典
+        """
+        if fields is None:
+            document, _ = self._find_or_create(bot_id, group_id, user_id, None)
             return document
 
-        # 步骤2：文档不存在，查询9999模板和其他群组文档
-        current_time = datetime.utcnow()
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None and request.covers(fields):
+            return request.read(fields)
 
-        # 查询9999模板文档
-        template_doc = self.collection.find_one({
-            "bot_id": bot_id,
-            "group_id": self.TEMPLATE_GROUP_ID,
-            "user_id": user_id
-        })
+        cached = self._cache_get(bot_id, group_id, user_id, fields)
+        if cached is not None:
+            return cached
 
-        # 查询其他群组的文档（排除9999和当前群组）
-        other_group_docs = list(self.collection.find({
-            "bot_id": bot_id,
-            "user_id": user_id,
-            "group_id": {"$nin": [self.TEMPLATE_GROUP_ID, group_id]}
-        }).limit(1))
+        projection = {**{field: 1 for field in fields}, "_id": 0}
+        document, created = self._find_or_create(bot_id, group_id, user_id, projection)
+        if created:
+            document = {field: document[field] for field in fields if field in document}
+        self._cache_put(bot_id, group_id, user_id, fields, document)
+        return document
 
-        # 步骤3：判断场景并决定继承策略
-        # 场景A：9999模板存在 → 从9999继承
-        # 场景B：9999不存在，但有其他群组文档 → 从其他群组创建9999，再从9999继承
-        # 场景C：9999和其他群组都不存在 → 创建全新文档
-
-        has_template = template_doc is not None
-        has_other_group = len(other_group_docs) > 0
-
-        if not has_template and has_other_group:
-            # 场景B：从其他群组创建9999模板
-            source_doc = other_group_docs[0]
-            template_doc = self._create_template_from_source(bot_id, user_id, source_doc, current_time)
-
-        # 步骤4：构建新文档（根据跨群配置决定继承哪些字段）
-        new_doc = self._build_document_from_template(
-            bot_id=bot_id,
-            group_id=group_id,
-            user_id=user_id,
-            template_doc=template_doc,
-            current_time=current_time
-        )
+    def get_recent_history(self, bot_id: str, group_id: str, user_id: str,
+                           count: int) -> List[Any]:
+        """
+        获取最新的count条history_entries，由服务端$slice截取，只传输需要的条目
 
-        # 步骤5：插入新文档并重新读取
-        self.collection.insert_one(new_doc)
+        count<=0 时不查询数据库，直接返回空列表
+        """
+        if count <= 0:
+            return []
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None and request.history_count >= count:
+            document = request.document
+        else:
+            document, _ = self._find_or_create(
+                bot_id, group_id, user_id,
+                {"user_id": 1, "history_entries": {"$slice": -count}, "_id": 0}
+            )
+        history_entries = document.get("history_entries")
+        if not isinstance(history_entries, list):
+            return []
+        # 新建文档未经过服务端投影，这里同样只保留最新count条
+        return history_entries[-count:]
+
+    def _find_or_create(self, bot_id: str, group_id: str, user_id: str,
+                        projection: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        """
+        读取用户文档，不存在则创建默认文档并按跨群配置从9999模板继承
+
+        参数：
+            projection: 读取已有文档时使用的投影，None表示整个文档
 
-        # 重新读取并返回
-        document = self.collection.find_one({
+        返回：(文档, 是否为本次新建)；新建时返回本地构建的完整文档
+        """
+        steps = self._find_or_create_steps(bot_id, group_id, user_id, projection)
+        try:
+            name, args, kwargs = next(steps)
+            while True:
+                result = getattr(self.collection, name)(*args, **kwargs)
+                if name == "aggregate":
+                    result = list(result)
+                name, args, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    def _find_or_create_steps(self, bot_id: str, group_id: str, user_id: str,
+                              projection: Optional[Dict[str, Any]]
+                              ) -> Generator[Tuple[str, tuple, Dict[str, Any]], Any, Tuple[Dict[str, Any], bool]]:
+        """
+        _find_or_create 的流程（同步与异步版本共用）：依次产出 (集合方法名, 位置参数, 关键字参数)，
+        由调用方执行后把结果（aggregate 为文档列表）送回，最终返回 (文档, 是否为本次新建)
+        """
+        query = {
             "bot_id": bot_id,
             "group_id": group_id,
             "user_id": user_id
-        })
+        }
 
-        return document if document else new_doc
+        # 步骤1：读取文档，已存在时一次往返返回（热路径只读，不经过写入路径）
+        document = yield "find_one", (query, projection), {}
+        if document is not None:
+            return document, False
 
-    def _create_template_from_source(self, bot_id: str, user_id: str,
-                                      source_doc: Dict[str, Any],
-                                      current_time: datetime) -> Dict[str, Any]:
-        """
-        从源文档创建9999模板文档
+        # 步骤2：文档不存在，以upsert+$setOnInsert创建默认文档
+        # 注意：这里不能用$currentDate，它对已有文档同样生效，会刷新updated_at而破坏跨天判断
+        # 返回写入前的文档：并发请求已先行创建时即为该文档（$setOnInsert对已有文档不生效），None表示本次新插入
+        current_time = datetime.utcnow()
+        document = yield "find_one_and_update", (query, {"$setOnInsert": self._build_default_fields(current_time)}), {
+            "projection": projection,
+            "upsert": True,
+            "return_document": ReturnDocument.BEFORE
+        }
+        if document is not None:
+            return document, False
 
-        参数：
-            bot_id: 机器人ID
-            user_id: 用户ID
-            source_doc: 源群组文档
-            current_time: 当前时间
+        document = {**query, **self._build_default_fields(current_time)}
+
+        # 步骤3：文档为本次新建，查询9999模板（优先使用模板缓存）并决定继承策略
+        # 场景A：9999模板存在 → 从9999继承
+        # 场景B：9999不存在，但有其他群组文档 → 从其他群组创建9999，再从9999继承
+        # 场景C：9999和其他群组都不存在 → 保持默认文档
+        template_doc = self._template_cache_get(bot_id, user_id)
+        if template_doc is None:
+            # 模板与其他群组文档合并为一次聚合查询：模板优先，其次任取一个其他群组文档
+            docs = yield "aggregate", (self._template_or_source_pipeline(bot_id, group_id, user_id),), {}
+            template_doc, source_doc = self._split_template_or_source(docs)
+            if source_doc is not None:
+                # 场景B：以upsert+$setOnInsert创建9999模板：同一用户在多个群并发首次出现时，
+                # 由唯一索引保证只有一个请求插入，其余请求直接取回已存在的模板，不会触发E11000
+                template = self._build_template_from_source(bot_id, user_id, source_doc, current_time)
+                template_doc = yield "find_one_and_update", (
+                    self._template_key(bot_id, user_id),
+                    {"$setOnInsert": self._template_insert_fields(template)}
+                ), {
+                    "projection": _TEMPLATE_PROJECTION,
+                    "upsert": True,
+                    "return_document": ReturnDocument.AFTER
+                }
+            self._template_cache_put(bot_id, user_id, template_doc)
+
+        # 步骤4：根据跨群配置把继承字段写入新文档（无需再重新读取）
+        inherited = self._get_inherited_fields(template_doc)
+        if inherited:
+            yield "update_one", (query, {"$set": inherited}), {}
+            document.update(inherited)
+            self._cache_invalidate(bot_id, group_id, user_id)
+
+        return document, True
+
+    def _template_or_source_pipeline(self, bot_id: str, group_id: str,
+                                     user_id: str) -> List[Dict[str, Any]]:
+        """
+        新建文档时查询继承来源的聚合管道：同一用户除当前群组外的文档中，9999模板排在最前，只取一条
 
-        返回：创建的9999模板文档
+        模板只投影继承所需字段；其他群组文档额外带回long_term_memory用于创建模板
         """
-        template_doc = {
+        is_template = {"$eq": ["$group_id", self.TEMPLATE_GROUP_ID]}
+        return [
+            {"$match": {"bot_id": bot_id, "user_id": user_id, "group_id": {"$ne": group_id}}},
+            {"$addFields": {"_is_template": is_template}},
+            {"$sort": {"_is_template": -1}},
+            {"$limit": 1},
+            {"$project": {
+                **_TEMPLATE_PROJECTION,
+                "group_id": 1,
+                "long_term_memory": {"$cond": ["$_is_template", "$$REMOVE", "$long_term_memory"]},
+            }},
+        ]
+
+    def _split_template_or_source(self, docs: List[Dict[str, Any]]
+                                  ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """把继承来源查询的结果拆分为 (9999模板, 其他群组源文档)，两者至多一个非None"""
+        if not docs:
+            return None, None
+        doc = docs[0]
+        if doc.get("group_id") == self.TEMPLATE_GROUP_ID:
+            return {key: value for key, value in doc.items() if key in _TEMPLATE_PROJECTION}, None
+        return None, doc
+
+    def _template_key(self, bot_id: str, user_id: str) -> Dict[str, str]:
+        """9999模板文档的查询条件"""
+        return {
+            "bot_id": bot_id,
+            "group_id": self.TEMPLATE_GROUP_ID,
+            "user_id": user_id
+        }
+
+    @staticmethod
+    def _template_insert_fields(template_doc: Dict[str, Any]) -> Dict[str, Any]:
+        """模板文档中由$setOnInsert写入的字段（键字段由upsert的查询条件补齐）"""
+        return {
+            key: value for key, value in template_doc.items()
+            if key not in ("bot_id", "group_id", "user_id")
+        }
+
+    def _build_template_from_source(self, bot_id: str, user_id: str,
+                                    source_doc: Dict[str, Any],
+                                    current_time: datetime) -> Dict[str, Any]:
+        """从源群组文档构建9999模板文档（不写入数据库）"""
+        return {
             "bot_id": bot_id,
             "group_id": self.TEMPLATE_GROUP_ID,
             "user_id": user_id,
@@ -190,55 +845,32 @@ class MongoDBSystem:
             "history_entries": [],
             "history_stats": {"total_histories": 0},
             # 时间戳
-            "created_at": current_time.isoformat(),
-            "updated_at": current_time.isoformat(),
+            "created_at": current_time,
+            "updated_at": current_time,
         }
 
-        # 插入9999模板文档
-        self.collection.insert_one(template_doc)
-
-        return template_doc
-
-    def _build_document_from_template(self, bot_id: str, group_id: str, user_id: str,
-                                       template_doc: Optional[Dict[str, Any]],
-                                       current_time: datetime) -> Dict[str, Any]:
+    def _build_default_fields(self, current_time: datetime) -> Dict[str, Any]:
         """
-        根据模板文档和跨群配置构建新文档
+        构建新文档的默认字段（不含 bot_id/group_id/user_id，由upsert的查询条件补齐）
 
         参数：
-            bot_id: 机器人ID
-            group_id: 群组ID
-            user_id: 用户ID
-            template_doc: 9999模板文档（可能为None）
             current_time: 当前时间
 
-        返回：构建的新文档
+        返回：默认字段字典
         """
-        # 从模板继承或使用默认值的辅助函数
-        def get_value(field_name: str, default_value: Any, cross_group_enabled: bool) -> Any:
-            if template_doc and cross_group_enabled:
-                return template_doc.get(field_name, default_value)
-            return default_value
-
-        # 构建新文档
-        new_doc = {
-            "bot_id": bot_id,
-            "group_id": group_id,
-            "user_id": user_id,
-
-            # blacklist相关字段（受blacklist_cross_group影响）
-            "block_stats": get_value("block_stats", self._get_default_block_stats(), self._blacklist_cross_group),
+        return {
+            # blacklist相关字段
+            "block_stats": self._get_default_block_stats(),
 
-            # favor相关字段（受favor_cross_group影响）
-            "favor_value": get_value("favor_value", 0, self._favor_cross_group),
-            "last_favor_change": get_value("last_favor_change", 0, self._favor_cross_group),
+            # favor相关字段
+            "favor_value": 0,
+            "last_favor_change": 0,
 
-            # persona相关字段（受persona_cross_group影响）
-            "persona_attributes": get_value("persona_attributes", self._get_default_persona_attributes(), self._persona_cross_group),
+            # persona相关字段
+            "persona_attributes": self._get_default_persona_attributes(),
 
             # usage相关字段
-            # daily_usage_count受usage_limit_cross_group影响
-            "daily_usage_count": get_value("daily_usage_count", 0, self._usage_limit_cross_group),
+            "daily_usage_count": 0,
 
             # total_usage各群独立，不继承
             "total_usage": self._get_default_total_usage(),
@@ -249,17 +881,56 @@ class MongoDBSystem:
             "history_stats": {"total_histories": 0},
 
             # 系统字段
-            "created_at": current_time.isoformat(),
-            "updated_at": current_time.isoformat(),
+            "created_at": current_time,
+            "updated_at": current_time,
+            "_v": 0,
         }
 
-        return new_doc
+    def _get_inherited_fields(self, template_doc: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        根据跨群配置从模板文档中取出需要继承的字段
+
+        参数：
+            template_doc: 9999模板文档（可能为None）
+
+        返回：需要覆盖到新文档上的字段（无模板或未开启跨群时为空）
+        """
+        if not template_doc:
+            return {}
+
+        inherited: Dict[str, Any] = {}
+
+        # blacklist相关字段（受blacklist_cross_group影响）
+        if self._blacklist_cross_group:
+            inherited["block_stats"] = template_doc.get("block_stats", self._get_default_block_stats())
+
+        # favor相关字段（受favor_cross_group影响）
+        if self._favor_cross_group:
+            inherited["favor_value"] = template_doc.get("favor_value", 0)
+            inherited["last_favor_change"] = template_doc.get("last_favor_change", 0)
+
+        # persona相关字段（受persona_cross_group影响）
+        if self._persona_cross_group:
+            inherited["persona_attributes"] = template_doc.get("persona_attributes", self._get_default_persona_attributes())
+
+        # daily_usage_count受usage_limit_cross_group影响
+        if self._usage_limit_cross_group:
+            inherited["daily_usage_count"] = template_doc.get("daily_usage_count", 0)
+
+        return inherited
     
     def update_document(self, bot_id: str, group_id: str, user_id: str, 
                        updates: Dict[str, Any]) -> Any:
-        """更新用户文档"""
-        updates["updated_at"] = datetime.utcnow().isoformat()
-        
+        """
+        更新用户文档（updated_at由服务端在写入时以BSON Date记录）
+
+        该用户有进行中的请求时只暂存写入并返回None，由 flush_request 统一提交
+        """
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None:
+            request.pending.update(updates)
+            return None
+
         result = self.collection.update_one(
             {
                 "bot_id": bot_id,
@@ -267,18 +938,19 @@ class MongoDBSystem:
                 "user_id": user_id
             },
             {
-                "$set": updates
+                "$set": updates,
+                "$currentDate": {"updated_at": True}
             },
             upsert=True
         )
+        self._cache_invalidate(bot_id, group_id, user_id)
         
         return result
     
     def get_field(self, bot_id: str, group_id: str, user_id: str, 
                   field_name: str) -> Any:
         """提取指定字段"""
-        document = self.get_document(bot_id, group_id, user_id)
-        return document.get(field_name)
+        return self.get_projected(bot_id, group_id, user_id, (field_name,)).get(field_name)
     
     def update_field(self, bot_id: str, group_id: str, user_id: str,
                     field_name: str, new_value: Any) -> Any:
@@ -286,6 +958,259 @@ class MongoDBSystem:
         updates = {field_name: new_value}
         return self.update_document(bot_id, group_id, user_id, updates)
 
+    def increment_field(self, bot_id: str, group_id: str, user_id: str,
+                        field_name: str, amount: int = 1) -> Optional[Dict[str, Any]]:
+        """
+        对数值字段加amount（$inc），并在同一次往返中取回该字段写入前的值
+
+        该用户有进行中的请求时同步更新快照并暂存自增，由 flush_request 统一提交；
+        提交不校验版本时，$inc 也不会覆盖并发请求已写入的计数
+
+        返回：写入前文档（只投影该字段），文档原本不存在时为None
+        """
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None:
+            previous = request.read((field_name,))
+            if field_name in request.pending:
+                # 本次请求已整体写入该字段，自增直接体现在暂存值中
+                request.pending[field_name] += amount
+            else:
+                request.document[field_name] = previous.get(field_name, 0) + amount
+                request.increments[field_name] = request.increments.get(field_name, 0) + amount
+            return previous
+
+        previous = self.collection.find_one_and_update(
+            {
+                "bot_id": bot_id,
+                "group_id": group_id,
+                "user_id": user_id
+            },
+            {
+                "$inc": {field_name: amount},
+                "$currentDate": {"updated_at": True}
+            },
+            projection={field_name: 1, "_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._cache_invalidate(bot_id, group_id, user_id)
+        return previous
+
+    def inc_array_field(self, bot_id: str, group_id: str, user_id: str,
+                        field_name: str, indices: List[int], counter: str = "hit_count") -> Any:
+        """
+        对数组字段中指定下标元素的计数字段各加1（$inc 点路径，只传输下标，不回写整个数组）
+
+        该用户有进行中的请求时同步更新快照中的元素并暂存自增，由 flush_request 统一提交
+        """
+        if not indices:
+            return None
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None:
+            array = request.read((field_name,)).get(field_name)
+            for idx in indices:
+                if isinstance(array, list) and idx < len(array) and isinstance(array[idx], dict):
+                    array[idx][counter] = array[idx].get(counter, 0) + 1
+                path = f"{field_name}.{idx}.{counter}"
+                request.increments[path] = request.increments.get(path, 0) + 1
+            return None
+
+        result = self.collection.update_one(
+            {
+                "bot_id": bot_id,
+                "group_id": group_id,
+                "user_id": user_id,
+                # 数组已被缩短时不写入，避免$inc把数组补齐为null
+                f"{field_name}.{max(indices)}": {"$exists": True}
+            },
+            {
+                "$inc": {f"{field_name}.{idx}.{counter}": 1 for idx in indices},
+                "$currentDate": {"updated_at": True}
+            }
+        )
+        self._cache_invalidate(bot_id, group_id, user_id)
+        return result
+
+    def search_memories_by_embedding(self, bot_id: str, group_id: str, user_id: str,
+                                     query_embedding: List[float], top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        在服务端按向量余弦检索最相关的top_k条记忆，只传回命中条目（不含向量）
+
+        记忆是单个文档内的数组元素，$vectorSearch（按文档排序）无法对其排序，
+        这里用聚合表达式在服务端计算余弦并取top-k（$sortArray 需要 MongoDB 5.2+）
+
+        返回：[{idx, score, user_input, memory_description, hit_count}] 按相似度降序（相同时下标小的在前）；
+        快照中已有long_term_memory、文档不存在、并非每条记忆都带有同维度embedding、
+        或服务端不支持所需的聚合操作符时返回None，由调用方在本地检索
+        """
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None and request.covers(("long_term_memory",)):
+            return None
+        query_norm = math.sqrt(sum(x * x for x in query_embedding))
+        if top_k <= 0 or not query_norm:
+            return []
+
+        dot = {"$reduce": {
+            "input": {"$zip": {"inputs": ["$$embedding", list(query_embedding)]}},
+            "initialValue": 0,
+            "in": {"$add": ["$$value", {"$multiply": [{"$arrayElemAt": ["$$this", 0]}, {"$arrayElemAt": ["$$this", 1]}]}]}
+        }}
+        norm = {"$ifNull": ["$$entry.embedding_norm", {"$sqrt": {"$reduce": {
+            "input": "$$embedding",
+            "initialValue": 0,
+            "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
+        }}}]}
+        scored = {"$map": {
+            "input": {"$range": [0, {"$size": "$memories"}]},
+            "as": "idx",
+            "in": {"$let": {
+                "vars": {"entry": {"$arrayElemAt": ["$memories", "$$idx"]}},
+                "in": {"$let": {
+                    "vars": {"embedding": {"$cond": [{"$isArray": "$$entry.embedding"}, "$$entry.embedding", []]}},
+                    "in": {
+                        "idx": "$$idx",
+                        "embedded": {"$eq": [{"$size": "$$embedding"}, len(query_embedding)]},
+                        "user_input": "$$entry.user_input",
+                        "memory_description": "$$entry.memory_description",
+                        "hit_count": "$$entry.hit_count",
+                        "score": {"$let": {
+                            "vars": {"dot": dot, "norm": norm},
+                            "in": {"$cond": [
+                                {"$gt": ["$$norm", 0]},
+                                {"$divide": ["$$dot", {"$multiply": ["$$norm", query_norm]}]},
+                                0
+                            ]}
+                        }}
+                    }
+                }}
+            }}
+        }}
+        pipeline = [
+            {"$match": {"bot_id": bot_id, "group_id": group_id, "user_id": user_id}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "memories": {
+                "$cond": [{"$isArray": "$long_term_memory"}, "$long_term_memory", []]
+            }}},
+            {"$project": {"scored": scored}},
+            {"$project": {
+                "embedded": {"$allElementsTrue": ["$scored.embedded"]},
+                "top": {"$slice": [{"$sortArray": {
+                    "input": {"$filter": {"input": "$scored", "cond": {"$gt": ["$$this.score", 0]}}},
+                    "sortBy": {"score": -1, "idx": 1}
+                }}, top_k]}
+            }}
+        ]
+        try:
+            documents = list(self.collection.aggregate(pipeline))
+        except OperationFailure:
+            # 旧版本服务端不支持$sortArray等操作符：之后的请求改为随快照读取记忆数组，本次由调用方在本地检索
+            self.SERVER_MEMORY_SEARCH = False
+            return None
+        if not documents or not documents[0]["embedded"]:
+            return None
+        return documents[0]["top"]
+
+    def get_and_set_field(self, bot_id: str, group_id: str, user_id: str,
+                          field_name: str, new_value: Any) -> Optional[Dict[str, Any]]:
+        """
+        写入指定字段并在同一次往返中取回该字段写入前的值
+
+        返回：写入前文档（只投影该字段），文档原本不存在时为None
+        """
+        request = self._request_for(bot_id, group_id, user_id)
+        if request is not None:
+            # 请求开始时已确保文档存在，写入前的值取自快照
+            previous = request.read((field_name,))
+            request.pending[field_name] = new_value
+            return previous
+
+        previous = self.collection.find_one_and_update(
+            {
+                "bot_id": bot_id,
+                "group_id": group_id,
+                "user_id": user_id
+            },
+            {
+                "$set": {field_name: new_value},
+                "$currentDate": {"updated_at": True}
+            },
+            projection={field_name: 1, "_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        self._cache_invalidate(bot_id, group_id, user_id)
+        return previous
+
+
+class MongoDBSystemAsync(MongoDBSystem):
+    """
+    统一的MongoDB系统（异步版本）- 基于AsyncMongoClient
+
+    只有请求开始时的读取（begin_request_async）和结束时的写入（flush_request_async）访问数据库，
+    期间各管理器的读写都落在 ChatRequestContext 快照上，因此管理器无需改为异步
+    """
+
+    SERVER_MEMORY_SEARCH = False
+
+    def __init__(self, mongo_url: str, db_name: str = "roza_database", cache_ttl: float = 0):
+        self.client = _get_async_client(mongo_url)
+        self.db_name = db_name
+        self.db = self.client[db_name]
+        self.collection = self.db["user_data"]
+        self.cache_ttl = cache_ttl
+        self._init_call_state()
+
+    def search_memories_by_embedding(self, bot_id: str, group_id: str, user_id: str,
+                                     query_embedding: List[float], top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """异步版本的记忆数组总在请求开始时随快照读取，始终在本地检索"""
+        return None
+
+    async def begin_request_async(self, bot_id: str, group_id: str, user_id: str,
+                                  fields: Tuple[str, ...], history_count: int = 0,
+                                  refresh: bool = False):
+        """异步版本的 begin_request"""
+        self._request = None
+        if not fields and history_count <= 0:
+            return
+
+        cache_fields = fields + ("_v",)
+        document = None
+        if history_count <= 0 and not refresh:
+            document = self._cache_get(bot_id, group_id, user_id, cache_fields)
+        if document is None:
+            document, created = await self._find_or_create_async(
+                bot_id, group_id, user_id, ChatRequestContext.projection(fields, history_count)
+            )
+            if created and history_count > 0:
+                document["history_entries"] = document["history_entries"][-history_count:]
+            self._cache_put(bot_id, group_id, user_id, cache_fields, document)
+
+        self._request = ChatRequestContext(bot_id, group_id, user_id, fields, document, history_count)
+
+    async def flush_request_async(self, check_version: bool = True) -> bool:
+        """异步版本的 flush_request"""
+        request, self._request = self._request, None
+        operations = request.update_operations(check_version) if request is not None else []
+        if not operations:
+            return True
+        result = await self.collection.bulk_write(operations, ordered=False)
+        self._cache_invalidate(*request.key)
+        return not check_version or result.matched_count > 0
+
+    async def _find_or_create_async(self, bot_id: str, group_id: str, user_id: str,
+                                    projection: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        """异步版本的 _find_or_create（流程见 _find_or_create_steps）"""
+        steps = self._find_or_create_steps(bot_id, group_id, user_id, projection)
+        try:
+            name, args, kwargs = next(steps)
+            while True:
+                result = await getattr(self.collection, name)(*args, **kwargs)
+                if name == "aggregate":
+                    result = await result.to_list()
+                name, args, kwargs = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
 
 class UtilityFunctions:
     """通用工具函数类"""
@@ -302,6 +1227,11 @@ class UtilityFunctions:
     @staticmethod
     def ensure_json_serializable(obj: Any) -> Any:
         """确保对象是JSON可序列化的"""
+        # 常见类型按精确类型分派；标量子节点直接复用，不再递归
+        handler = _JSON_DISPATCH.get(type(obj))
+        if handler is not None:
+            return handler(obj)
+        # 子类（如bson的SON）等其余类型沿用isinstance判断
         if isinstance(obj, datetime):
             return obj.isoformat()
         elif isinstance(obj, dict):
@@ -317,6 +1247,9 @@ class UtilityFunctions:
     def dict_to_json_string(obj: Any) -> str:
         """将字典对象转换为JSON字符串"""
         if isinstance(obj, dict):
+            if orjson is not None:
+                # datetime等类型由orjson原生处理，无需先遍历转换
+                return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS).decode()
             serializable_obj = UtilityFunctions.ensure_json_serializable(obj)
             return json.dumps(serializable_obj, ensure_ascii=False)
         elif isinstance(obj, str):
@@ -324,12 +1257,32 @@ class UtilityFunctions:
         else:
             return str(obj)
     
+    @staticmethod
+    def parse_datetime(value: Any) -> Optional[datetime]:
+        """解析时间字段：兼容BSON Date（读出为datetime）与ISO格式字符串，无法解析时返回None"""
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, str) and value:
+            try:
+                # 解析ISO格式时间：2023-12-26T14:37:11.123456
+                return datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                return None
+        return None
+
     @staticmethod
     def safe_int_convert(value: Any, default: int = 0) -> int:
         """安全转换为整数"""
+        value_type = type(value)
+        # 数据库读出的计数已是int，直接返回（bool不走此分支，仍按原逻辑返回default）
+        if value_type is int:
+            return value
         try:
             if value is None:
                 return default
+            if value_type is str:
+                value = value.strip()
+                return int(value) if value else default
             if isinstance(value, str) and not value.strip():
                 return default
             return int(str(value).strip())
@@ -337,6 +1290,66 @@ class UtilityFunctions:
             return default
 
 
+_JSON_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+
+def _json_identity(obj: Any) -> Any:
+    return obj
+
+
+def _json_dict(obj: Dict[Any, Any]) -> Dict[Any, Any]:
+    return {
+        k: v if type(v) in _JSON_SCALAR_TYPES else UtilityFunctions.ensure_json_serializable(v)
+        for k, v in obj.items()
+    }
+
+
+def _json_list(obj: List[Any]) -> List[Any]:
+    return [
+        item if type(item) in _JSON_SCALAR_TYPES else UtilityFunctions.ensure_json_serializable(item)
+        for item in obj
+    ]
+
+
+_JSON_DISPATCH = {
+    dict: _json_dict,
+    list: _json_list,
+    str: _json_identity,
+    int: _json_identity,
+    float: _json_identity,
+    bool: _json_identity,
+    type(None): _json_identity,
+    datetime: datetime.isoformat,
+}
+
+
+
+# orjson：非字符串键转为字符串，dict/list/str的子类（如bson的SON）交给 _orjson_default 处理，与标准库输出保持一致
+_ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS) if orjson is not None else 0
+
+
+def _orjson_default(obj: Any) -> Any:
+    """orjson无法原生序列化的对象：容器子类转为基础类型，其余转为字符串（同 ensure_json_serializable）"""
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, list):
+        return list(obj)
+    return str(obj)
+
+
+def _fast_int(value: Any, default: int = 0) -> int:
+    """
+    safe_int_convert 的快速路径：int与纯数字字符串直接转换（无需try/except），
+    其余情况（空白、符号、None等）交给 safe_int_convert，结果与其一致
+    """
+    value_type = type(value)
+    if value_type is int:
+        return value
+    if value_type is str and value.isdecimal():
+        return int(value)
+    return UtilityFunctions.safe_int_convert(value, default)
+
+
 class BlacklistManager:
     """黑名单管理器 - 核心业务逻辑"""
     
@@ -358,22 +1371,23 @@ class BlacklistManager:
         # 获取当前用户的block_stats
         block_stats = self.mongo_system.get_field(bot_id, group_id, user_id, "block_stats")
         
-        if not isinstance(block_stats, dict):
-            block_stats = {
-                "block_status": True,
-                "block_count": 0,
-                "last_operate_time": datetime.utcnow().isoformat()
-            }
+        # 已有block_stats子文档时只写入变化的子字段（点路径$set），否则整体写入默认结构
+        stored_as_document = isinstance(block_stats, dict)
+        if not stored_as_document:
+            block_stats = {**_DEFAULT_BLOCK_STATS, "last_operate_time": datetime.utcnow().isoformat()}
+        changed_field = None
         
         block_status = block_stats.get("block_status", True)
         block_count = block_stats.get("block_count", 0)
         last_operate_time_str = block_stats.get("last_operate_time", datetime.utcnow().isoformat())
         
         # 解析last_operate_time
-        try:
-            last_operate_dt = datetime.fromisoformat(last_operate_time_str.replace('Z', '+00:00'))
-            last_operate_timestamp = last_operate_dt.timestamp()
-        except (ValueError, AttributeError):
+        last_operate_timestamp = None
+        if isinstance(last_operate_time_str, str):
+            last_operate_timestamp = _iso_to_timestamp(last_operate_time_str)
+        elif isinstance(last_operate_time_str, datetime):
+            last_operate_timestamp = last_operate_time_str.timestamp()
+        if last_operate_timestamp is None:
             last_operate_timestamp = timestamp
         
         # 计算时间差
@@ -393,6 +1407,7 @@ class BlacklistManager:
                 if delta_time >= warn_lifespan:
                     # 时间差大于warn_lifespan，重置block_count
                     block_stats["block_count"] = 0
+                    changed_field = "block_count"
                     # 不更新last_operate_time
                     need_update = True
                     allow_continue = True
@@ -404,6 +1419,7 @@ class BlacklistManager:
             if delta_time >= block_lifespan:
                 # 时间差大于block_lifespan，允许对话
                 block_stats["block_status"] = True
+                changed_field = "block_status"
                 # 不更新last_operate_time
                 need_update = True
                 allow_continue = True
@@ -416,11 +1432,16 @@ class BlacklistManager:
         
         # 更新数据库
         if need_update:
-            update_result = self.mongo_system.update_field(
-                bot_id, group_id, user_id, "block_stats", block_stats
-            )
-            matched_count = update_result.matched_count
-            modified_count = update_result.modified_count
+            if stored_as_document:
+                previous = self.mongo_system.get_and_set_field(
+                    bot_id, group_id, user_id, f"block_stats.{changed_field}", block_stats[changed_field]
+                )
+            else:
+                previous = self.mongo_system.get_and_set_field(
+                    bot_id, group_id, user_id, "block_stats", block_stats
+                )
+            # 写入前文档存在即匹配1条；updated_at随写入刷新，因此匹配即修改
+            matched_count = modified_count = 0 if previous is None else 1
         else:
             # 模拟一个成功的结果
             matched_count = 1
@@ -466,28 +1487,29 @@ class UsageLimitManager:
         返回：是否允许继续、停止消息、用量信息
         overusage_output可以是字符串或字符串数组
         """
-        # 获取当前用户的用量数据和最后更新时间
-        current_usage = self.mongo_system.get_field(bot_id, group_id, user_id, "daily_usage_count")
-        updated_at_str = self.mongo_system.get_field(bot_id, group_id, user_id, "updated_at")
-        
-        # 安全转换数值
-        current_usage_val = self.util.safe_int_convert(current_usage, 0)
-        
         # 格式化当前日期
         current_date_str = self.format_date(year, month, day)
-        current_date_val = self.util.safe_int_convert(current_date_str, 19700101)
+        current_date_val = _fast_int(current_date_str, 19700101)
+
+        # 请求快照中直接读取，写入随请求一起提交；否则用一条原子管道更新完成计数，取回更新前的值
+        atomic = not self.mongo_system.in_request(bot_id, group_id, user_id)
+        if atomic:
+            usage_doc = self.mongo_system.increment_daily_usage(
+                bot_id, group_id, user_id, current_date_str, usage_limit
+            )
+        else:
+            # 获取当前用户的用量数据和最后更新时间（一次查询取回两个字段）
+            usage_doc = self.mongo_system.get_projected(
+                bot_id, group_id, user_id, ("daily_usage_count", "updated_at")
+            )
+        current_usage = usage_doc.get("daily_usage_count")
+        updated_at_str = usage_doc.get("updated_at")
         
-        # 从updated_at提取日期
-        last_request_date_val = 19700101
-        if updated_at_str:
-            try:
-                # 解析ISO格式时间：2023-12-26T14:37:11.123456
-                dt = datetime.fromisoformat(updated_at_str.replace('Z', '+00:00'))
-                # 转换为YYYYMMDD格式
-                last_request_date_str = f"{dt.year:04d}{dt.month:02d}{dt.day:02d}"
-                last_request_date_val = int(last_request_date_str)
-            except (ValueError, AttributeError):
-                last_request_date_val = 19700101
+        # 安全转换数值
+        current_usage_val = _fast_int(current_usage, 0)
+        
+        # 从updated_at提取日期（YYYYMMDD格式，无需完整解析时间）
+        last_request_date_val = _date_value(updated_at_str) or 19700101
         
         # 初始化返回值
         allow_continue = True
@@ -523,13 +1545,23 @@ class UsageLimitManager:
         
         # 如果允许继续，更新数据库
         if allow_continue or current_date_val > last_request_date_val:
-            # 更新用量计数
-            usage_result = self.mongo_system.update_field(
-                bot_id, group_id, user_id, "daily_usage_count", new_usage_count
-            )
-            
-            matched_count = usage_result.matched_count
-            modified_count = usage_result.modified_count
+            if atomic:
+                # 计数已由管道更新写入
+                matched_count = modified_count = 1
+            else:
+                if current_date_val == last_request_date_val and type(current_usage) is int:
+                    # 同一天内的计数以$inc暂存，最后一次不校验版本的提交也不会覆盖并发请求的计数
+                    previous = self.mongo_system.increment_field(
+                        bot_id, group_id, user_id, "daily_usage_count"
+                    )
+                else:
+                    # 跨天重置（或旧文档中计数不是整数）时整体写入
+                    previous = self.mongo_system.get_and_set_field(
+                        bot_id, group_id, user_id, "daily_usage_count", new_usage_count
+                    )
+
+                # 写入前文档存在即匹配1条；updated_at随写入刷新，因此匹配即修改
+                matched_count = modified_count = 0 if previous is None else 1
         else:
             # 不允许继续，不更新数据库
             matched_count = 0
@@ -546,6 +1578,36 @@ class UsageLimitManager:
         }
 
 
+@functools.lru_cache(maxsize=256)
+def _compile_favor_stages(prompts: Tuple[Any, ...],
+                          split_points: Tuple[Any, ...]) -> Tuple[Tuple[int, ...], Tuple[Any, ...]]:
+    """
+    预处理好感度阶段配置（同一部署的配置固定不变，结果按内容缓存）
+
+    返回：(严格递增的分割点, 与阶段数对齐的提示词)
+    """
+    # 清洗并排序分割点（严格递增）
+    valid_splits: List[int] = []
+    prev_val: Optional[int] = None
+    for split in split_points:
+        try:
+            split_int = int(split)
+        except (TypeError, ValueError):
+            continue
+        if prev_val is None or split_int > prev_val:
+            valid_splits.append(split_int)
+            prev_val = split_int
+
+    # 至少一个提示词
+    if not prompts:
+        prompts = ("好感度系统正常",)
+
+    # 提示词截断或用最后一条补齐到阶段数
+    stage_count = len(valid_splits) + 1
+    stage_prompts = prompts[:stage_count] + (prompts[-1],) * (stage_count - len(prompts))
+    return tuple(valid_splits), stage_prompts
+
+
 class FavorManager:
     """好感度管理器 - 核心业务逻辑"""
     
@@ -556,33 +1618,14 @@ class FavorManager:
     def generate_favor_prompt(self, prompts: List[str], split_points: List[int], 
                              favor_value: int) -> str:
         """根据好感度值确定阶段提示词，使用分割点划分阶段。"""
-        # 清洗并排序分割点（严格递增）
-        valid_splits: List[int] = []
-        prev_val: Optional[int] = None
-        for split in split_points:
-            try:
-                split_int = int(split)
-            except (TypeError, ValueError):
-                continue
-            if prev_val is None or split_int > prev_val:
-                valid_splits.append(split_int)
-                prev_val = split_int
-
-        # 至少一个提示词
-        if not prompts:
-            prompts = ["好感度系统正常"]
-
-        stage_count = len(valid_splits) + 1
-        if len(prompts) > stage_count:
-            prompts = prompts[:stage_count]
-        elif len(prompts) < stage_count:
-            prompts.extend([prompts[-1]] * (stage_count - len(prompts)))
-
-        # 根据分割点定位阶段
-        for idx, split_val in enumerate(valid_splits):
-            if favor_value < split_val:
-                return prompts[idx]
-        return prompts[len(valid_splits)]
+        try:
+            valid_splits, stage_prompts = _compile_favor_stages(tuple(prompts), tuple(split_points))
+        except TypeError:
+            # 配置中含不可哈希的元素，跳过缓存
+            valid_splits, stage_prompts = _compile_favor_stages.__wrapped__(tuple(prompts), tuple(split_points))
+
+        # 第一个大于favor_value的分割点即为所处阶段（favor_value等于分割点时属于下一阶段）
+        return stage_prompts[bisect.bisect_right(valid_splits, favor_value)]
     
     def get_favor_prompt(self, bot_id: str, group_id: str, user_id: str,
                         prompts: List[str], split_points: List[int],
@@ -628,41 +1671,15 @@ class PersonaManager:
         
         # 确保persona_attrs是字典类型
         if not isinstance(persona_attrs, dict):
-            persona_attrs = {
-                "basic_info": "",
-                "living_habits": "",
-                "psychological_traits": "",
-                "interests_preferences": "",
-                "dislikes": "",
-                "ai_expectations": "",
-                "memory_points": "",
-            }
-        
-        # 提取各个画像字段
-        basic_info = persona_attrs.get("basic_info", "")
-        living_habits = persona_attrs.get("living_habits", "")
-        psychological_traits = persona_attrs.get("psychological_traits", "")
-        interests_preferences = persona_attrs.get("interests_preferences", "")
-        dislikes = persona_attrs.get("dislikes", "")
-        ai_expectations = persona_attrs.get("ai_expectations", "")
-        memory_points = persona_attrs.get("memory_points", "")
+            persona_attrs = dict(_DEFAULT_PERSONA_ATTRIBUTES)
         
-        # 构建用户画像文本
-        persona_parts = []
-        if basic_info:
-            persona_parts.append(f"基本信息: {basic_info}")
-        if living_habits:
-            persona_parts.append(f"生活习惯: {living_habits}")
-        if psychological_traits:
-            persona_parts.append(f"心理特征: {psychological_traits}")
-        if interests_preferences:
-            persona_parts.append(f"兴趣偏好: {interests_preferences}")
-        if dislikes:
-            persona_parts.append(f"反感点: {dislikes}")
-        if ai_expectations:
-            persona_parts.append(f"对AI的期望: {ai_expectations}")
-        if memory_points:
-            persona_parts.append(f"希望记住的信息: {memory_points}")
+        # 按固定顺序拼接非空的画像字段
+        persona_parts = [
+            f"{label}: {value}"
+            for key, label in _PERSONA_LABELS
+            for value in (persona_attrs.get(key, ""),)
+            if value
+        ]
         
         # 如果没有任何画像信息，使用默认提示
         if not persona_parts:
@@ -680,6 +1697,45 @@ class PersonaManager:
         }
 
 
+def _format_context_time(value: Any) -> str:
+    """
+    把历史记录的created_at格式化为"2023年12月26日14时37分30秒"
+
+    BSON Date直接取属性；固定布局的ISO字符串（YYYY-MM-DDTHH:MM:SS...）按位置切片取整，
+    不构造datetime对象；其他格式回退到 UtilityFunctions.parse_datetime，无法解析时返回"未知时间"
+    """
+    if isinstance(value, datetime):
+        return f"{value.year}年{value.month}月{value.day}日{value.hour}时{value.minute}分{value.second}秒"
+    if (isinstance(value, str) and len(value) >= 19 and value[4] == '-' and value[7] == '-'
+            and value[10] in 'T ' and value[13] == ':' and value[16] == ':'):
+        try:
+            return (f"{int(value[0:4])}年{int(value[5:7])}月{int(value[8:10])}日"
+                    f"{int(value[11:13])}时{int(value[14:16])}分{int(value[17:19])}秒")
+        except ValueError:
+            pass
+    dt = UtilityFunctions.parse_datetime(value)
+    if dt is None:
+        return "未知时间"
+    return f"{dt.year}年{dt.month}月{dt.day}日{dt.hour}时{dt.minute}分{dt.second}秒"
+
+
+def _format_context_unit(entry: Any) -> str:
+    """把一条历史记录格式化为上下文单元：{时间:对方说XXX；你对此的反应是XXX}；字符串原样返回"""
+    if isinstance(entry, dict):
+        output = entry.get("output", {})
+        # 处理output：如果是字典，提取response字段或转为字符串
+        if isinstance(output, dict):
+            bot_response = output.get("response", str(output))
+        else:
+            bot_response = str(output)
+        return (f"{{{_format_context_time(entry.get('created_at', '未知时间'))}:"
+                f"{entry.get('user_name', '对方')}说{entry.get('user_query', '')}；你对此的反应是{bot_response}}}")
+    if isinstance(entry, str):
+        return entry
+    # 其他类型，转换为字符串
+    return str(entry)
+
+
 class ContextManager:
     """上下文管理器 - 核心业务逻辑"""
     
@@ -694,63 +1750,17 @@ class ContextManager:
         从history_entries中取出最新的context_pool_size条消息
         格式：{时间:对方说XXX；你对此的反应是XXX}
         """
-        # 获取历史对话记录
-        history_entries = self.mongo_system.get_field(bot_id, group_id, user_id, "history_entries")
-        
-        # 确保history_entries是列表类型
-        if not isinstance(history_entries, list):
-            history_entries = []
-        
-        # 获取最新的context_pool_size条消息
-        if context_pool_size <= 0:
-            # 如果context_pool_size为0或负数，不提取任何上下文
-            recent_histories = []
-        else:
-            # 从列表末尾取最新的几条
-            recent_histories = history_entries[-context_pool_size:] if len(history_entries) > 0 else []
+        # 获取最新的context_pool_size条消息（服务端截取；为0或负数时不提取任何上下文，也不查询）
+        recent_histories = self.mongo_system.get_recent_history(bot_id, group_id, user_id, context_pool_size)
         
         # 构建上下文文本
         if not recent_histories:
             context_text = "暂无历史对话记录"
             enhanced_prompt = main_prompt
         else:
-            # 将历史对话格式化为文本
+            # 将历史对话格式化为文本（单次遍历按原顺序拼接）
             # 格式：{时间:对方说XXX；你对此的反应是XXX}
-            context_parts = []
-            for entry in recent_histories:
-                if isinstance(entry, dict):
-                    # 提取字段
-                    created_at_raw = entry.get("created_at", "未知时间")
-                    user_name = entry.get("user_name", "对方")
-                    user_query = entry.get("user_query", "")
-                    output = entry.get("output", {})
-                    
-                    # 格式化时间：从ISO格式转换为"年月日时分秒"
-                    try:
-                        # 解析ISO格式时间：2023-12-26T14:37:11.123456
-                        dt = datetime.fromisoformat(created_at_raw.replace('Z', '+00:00'))
-                        # 格式化为：2023年12月26日14时37分30秒
-                        created_at = f"{dt.year}年{dt.month}月{dt.day}日{dt.hour}时{dt.minute}分{dt.second}秒"
-                    except (ValueError, AttributeError):
-                        created_at = "未知时间"
-                    
-                    # 处理output：如果是字典，提取response字段或转为字符串
-                    if isinstance(output, dict):
-                        bot_response = output.get("response", str(output))
-                    else:
-                        bot_response = str(output)
-                    
-                    # 格式化为单元：{时间:对方说XXX；你对此的反应是XXX}
-                    context_unit = f"{{{created_at}:{user_name}说{user_query}；你对此的反应是{bot_response}}}"
-                    context_parts.append(context_unit)
-                elif isinstance(entry, str):
-                    # 如果是字符串，直接添加
-                    context_parts.append(entry)
-                else:
-                    # 其他类型，转换为字符串
-                    context_parts.append(str(entry))
-            
-            context_text = "\n".join(context_parts)
+            context_text = "\n".join(map(_format_context_unit, recent_histories))
             
             # 构建完整提示词（将上下文添加到主提示词中）
             enhanced_prompt = f"{main_prompt}\n历史对话上下文：\n{context_text}\n"
@@ -762,6 +1772,89 @@ class ContextManager:
         }
 
 
+# 分词规则：连续的字母数字下划线或中文字符
+_TOKEN_RE = re.compile(r'[\w\u4e00-\u9fff]+')
+
+
+@functools.lru_cache(maxsize=4096)
+def _tokenize(text: str) -> Tuple[str, ...]:
+    """分词（记忆文本与查询在请求间反复出现，结果按原文缓存，返回不可变元组）"""
+    return tuple(_TOKEN_RE.findall(text.lower()))
+
+
+@functools.lru_cache(maxsize=4096)
+def _token_counts(text: str) -> Tuple[Tuple[str, int], ...]:
+    """文本的词频 ((词, 次数), ...)（记忆文本跨请求复用，不必每次重新分词计数）"""
+    return tuple(Counter(_tokenize(text)).items())
+
+
+def quantize_embedding(vector: List[float]) -> List[int]:
+    """
+    把记忆向量量化为int8整数列表（写入记忆时存为 entry["embedding_i8"]，体积约为float32的1/4）
+
+    按最大绝对值缩放到[-127, 127]；余弦相似度对每个向量的缩放不变，因此无需保存缩放系数
+    """
+    peak = max((abs(x) for x in vector), default=0.0)
+    if not peak:
+        return [0] * len(vector)
+    return [int(round(x * 127 / peak)) for x in vector]
+
+
+def _canonicalize_memory(entry: Any) -> Any:
+    """把旧的字符串记忆迁移为字典条目（原文同时作为检索文本与记忆描述），其他条目原样返回"""
+    if isinstance(entry, str):
+        return {"user_input": entry, "memory_description": entry, "hit_count": 0}
+    return entry
+
+
+# 记忆向量的存储字段：(向量字段, 对应的模长缓存字段, 是否为int8量化)，按优先顺序排列
+_EMBEDDING_FIELDS = (
+    ("embedding", "embedding_norm", False),
+    ("embedding_i8", "embedding_i8_norm", True),
+)
+
+
+# 记忆向量规模（条数×维度）达到该值且没有simsimd时，向量余弦改用numba并行内核
+_NUMBA_MIN_ELEMENTS = 1_000_000
+
+if numba is not None and np is not None:
+    # 不使用cache=True：代码节点的源码可能不在文件中，numba无处写入编译缓存
+    @numba.njit(parallel=True, fastmath=True)
+    def _cosine_batch(matrix, query):
+        """按行并行计算余弦相似度，每行一次遍历同时累加点积与模长"""
+        rows, dimension = matrix.shape
+        similarities = np.empty(rows, np.float64)
+        query_norm = 0.0
+        for i in range(dimension):
+            query_norm += query[i] * query[i]
+        query_norm = np.sqrt(query_norm)
+        for row in numba.prange(rows):
+            dot = 0.0
+            row_norm = 0.0
+            for i in range(dimension):
+                value = matrix[row, i]
+                dot += value * query[i]
+                row_norm += value * value
+            denominator = np.sqrt(row_norm) * query_norm
+            similarities[row] = dot / denominator if denominator > 0 else 0.0
+        return similarities
+else:
+    _cosine_batch = None
+
+
+def warm_up_kernels() -> bool:
+    """
+    预先编译可选的numba内核，避免进程内第一次大规模记忆检索承担JIT编译耗时
+
+    供常驻进程（如托管 main_async 的服务）在启动时调用；内核按参数类型编译，
+    用与检索时相同类型（C连续的float32矩阵/向量）的小数组调用一次即可。返回是否进行了编译
+    """
+    if _cosine_batch is None:
+        return False
+    _cosine_batch(np.zeros((2, 8), dtype=np.float32), np.ones(8, dtype=np.float32))
+    return True
+
+
 class MemoryManager:
     """长期记忆管理器 - 核心业务逻辑"""
     
@@ -773,44 +1866,207 @@ class MemoryManager:
         """简单分词器"""
         if not text:
             return []
-        tokens = re.findall(r'[\w\u4e00-\u9fff]+', text.lower())
-        return tokens
+        return list(_tokenize(text))
     
-    def build_vocabulary(self, texts: List[str]) -> List[str]:
-        """构建词汇表"""
-        vocabulary = set()
+    def build_vocabulary(self, texts: List[str]) -> Dict[str, int]:
+        """构建词汇表：词 -> 向量下标（按首次出现的顺序编号，无需排序）"""
+        vocabulary: Dict[str, int] = {}
         for text in texts:
             if text:
-                vocabulary.update(self.simple_tokenizer(text))
-        return sorted(vocabulary)
+                for token in _tokenize(text):
+                    if token not in vocabulary:
+                        vocabulary[token] = len(vocabulary)
+        return vocabulary
     
-    def text_to_vector(self, text: str, vocabulary: List[str]) -> List[int]:
-        """将文本转换为向量"""
+    def text_to_vector(self, text: str, vocabulary: Dict[str, int]) -> List[int]:
+        """将文本转换为向量（只遍历文本中出现的词）"""
         if not vocabulary or not text:
             return []
-        token_counts = Counter(self.simple_tokenizer(text))
-        return [token_counts.get(word, 0) for word in vocabulary]
+        vector = [0] * len(vocabulary)
+        for token, count in _token_counts(text):
+            index = vocabulary.get(token)
+            if index is not None:
+                vector[index] = count
+        return vector
     
     def cosine_similarity(self, vec1: List[int], vec2: List[int]) -> float:
         """计算余弦相似度"""
         if not vec1 or not vec2:
             return 0.0
-            
-        dot_product = sum(a * b for a, b in zip(vec1, vec2))
-        norm1 = math.sqrt(sum(a * a for a in vec1))
-        norm2 = math.sqrt(sum(b * b for b in vec2))
-        
-        if norm1 == 0 or norm2 == 0:
+
+        # 一次遍历同时累加点积与两个模长的平方（词频向量为整数，累加无舍入误差）
+        dot_product = norm1_sq = norm2_sq = 0
+        for a, b in zip(vec1, vec2):
+            dot_product += a * b
+            norm1_sq += a * a
+            norm2_sq += b * b
+
+        if not norm1_sq or not norm2_sq:
             return 0.0
-            
-        return dot_product / (norm1 * norm2)
+
+        return dot_product / math.sqrt(norm1_sq * norm2_sq)
     
-    def get_memory_prompt(self, bot_id: str, group_id: str, user_id: str,
-                         user_query: str, main_prompt: str,
-                         memory_retrieval_number: int = 5) -> Dict[str, Any]:
+    def compute_similarities(self, memory_inputs: List[str], user_query: str) -> Union[List[float], Any]:
         """
-        获取长期记忆并整合到主提示词中
-        从long_term_memory数组中检索相关记忆
+        计算查询与每条记忆的词袋余弦相似度（结果与逐条调用 cosine_similarity 一致）
+
+        每条文本的词频取自 _token_counts 缓存，按稀疏三元组 (行, 列, 计数) 存放，不展开为 记忆数×词表大小 的稠密矩阵；
+        有numpy时用 bincount 一次性求出各行点积与平方和，并直接返回numpy数组供 select_top_indices 使用
+        """
+        query_counts = dict(_token_counts(user_query))
+        # 词频为小整数，点积与平方和精确计算，开方与除法的顺序同 cosine_similarity
+        query_norm = math.sqrt(sum(count * count for count in query_counts.values()))
+
+        if np is None:
+            similarities = []
+            for text in memory_inputs:
+                counts = _token_counts(text)
+                dot = sum(count * query_counts.get(word, 0) for word, count in counts)
+                denominator = query_norm * math.sqrt(sum(count * count for _, count in counts))
+                similarities.append(dot / denominator if denominator else 0.0)
+            return similarities
+
+        word_to_idx: Dict[str, int] = {}
+        rows: List[int] = []
+        cols: List[int] = []
+        data: List[int] = []
+        for row, text in enumerate(memory_inputs):
+            for word, count in _token_counts(text):
+                rows.append(row)
+                cols.append(word_to_idx.setdefault(word, len(word_to_idx)))
+                data.append(count)
+
+        query = np.zeros(len(word_to_idx), dtype=np.float64)
+        for word, count in query_counts.items():
+            col = word_to_idx.get(word)
+            if col is not None:
+                query[col] = count
+
+        row_idx = np.asarray(rows, dtype=np.intp)
+        col_idx = np.asarray(cols, dtype=np.intp)
+        values = np.asarray(data, dtype=np.float64)
+        row_count = len(memory_inputs)
+        dots = np.bincount(row_idx, weights=values * query[col_idx], minlength=row_count)
+        denominators = query_norm * np.sqrt(np.bincount(row_idx, weights=values * values, minlength=row_count))
+        similarities = np.zeros(row_count, dtype=np.float64)
+        np.divide(dots, denominators, out=similarities, where=denominators > 0)
+        return similarities
+
+    def _memory_embedding_field(self, long_term_memory: List[Any],
+                                query_embedding: Optional[List[float]]) -> Optional[Tuple[str, str, bool]]:
+        """
+        选出所有记忆都具备、且与查询同维度的向量字段（float向量优先，其次int8量化向量）
+
+        返回：_EMBEDDING_FIELDS 中的一项；没有可用的向量字段时返回None（使用词袋检索）
+        """
+        if not query_embedding:
+            return None
+        dimension = len(query_embedding)
+        for field, norm_field, quantized in _EMBEDDING_FIELDS:
+            if all(
+                isinstance(entry, dict)
+                and isinstance(entry.get(field), list)
+                and len(entry[field]) == dimension
+                for entry in long_term_memory
+            ):
+                return field, norm_field, quantized
+        return None
+
+    def _ensure_embedding_norms(self, long_term_memory: List[Dict[str, Any]],
+                                embeddings: List[List[float]], norm_field: str) -> List[int]:
+        """为缺少模长缓存字段的记忆计算向量模长并写回条目，返回新增模长的下标（需要持久化）"""
+        missing = [idx for idx, entry in enumerate(long_term_memory) if norm_field not in entry]
+        if not missing:
+            return missing
+        if np is not None:
+            computed = np.linalg.norm(np.asarray([embeddings[idx] for idx in missing], dtype=np.float32), axis=1)
+            for idx, norm in zip(missing, computed.tolist()):
+                long_term_memory[idx][norm_field] = norm
+        else:
+            for idx in missing:
+                long_term_memory[idx][norm_field] = math.sqrt(sum(x * x for x in embeddings[idx]))
+        return missing
+
+    def compute_embedding_similarities(self, embeddings: List[List[float]],
+                                       query_embedding: List[float],
+                                       norms: Optional[List[float]] = None,
+                                       quantized: bool = False) -> Union[List[float], Any]:
+        """
+        计算查询向量与各记忆向量的余弦相似度
+
+        优先用simsimd的SIMD内核批量计算（1-余弦距离），其次numpy矩阵向量乘
+        （规模达到 _NUMBA_MIN_ELEMENTS 且安装了numba时用并行内核），最后纯Python；
+        提供norms（各记忆向量预存的模长）时余弦只需一次点积，查询向量的模长只计算一次；
+        quantized=True 表示记忆向量为int8量化值，simsimd下查询向量同样量化后走int8内核
+        """
+        if np is None:
+            query_norm = math.sqrt(sum(x * x for x in query_embedding))
+            if norms is None:
+                norms = [math.sqrt(sum(x * x for x in embedding)) for embedding in embeddings]
+            similarities = []
+            for embedding, norm in zip(embeddings, norms):
+                denominator = query_norm * norm
+                dot = sum(a * b for a, b in zip(query_embedding, embedding))
+                similarities.append(dot / denominator if denominator else 0.0)
+            return similarities
+
+        if simsimd is not None:
+            if quantized:
+                matrix = np.asarray(embeddings, dtype=np.int8)
+                query = np.asarray(quantize_embedding(query_embedding), dtype=np.int8)
+            else:
+                matrix = np.asarray(embeddings, dtype=np.float32)
+                query = np.asarray(query_embedding, dtype=np.float32)
+            distances = np.asarray(simsimd.cdist(query[np.newaxis, :], matrix, metric="cosine"))[0]
+            return 1.0 - distances.astype(np.float64)
+
+        # int8取值在float32中可精确表示
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if _cosine_batch is not None and matrix.size >= _NUMBA_MIN_ELEMENTS:
+            # 大规模记忆：并行内核在同一次遍历中计算点积与模长，不再使用预存模长
+            return _cosine_batch(matrix, query)
+
+        row_norms = np.asarray(norms, dtype=np.float64) if norms is not None else np.linalg.norm(matrix, axis=1)
+        denominators = row_norms * float(np.linalg.norm(query))
+        similarities = np.zeros(len(embeddings), dtype=np.float64)
+        np.divide(matrix @ query, denominators, out=similarities, where=denominators > 0)
+        return similarities
+
+    def select_top_indices(self, similarities: Union[List[float], Any], top_k: int) -> List[int]:
+        """
+        按相似度从高到低取前top_k条（相似度相同时下标小的优先），只保留相似度>0的下标
+
+        有numpy时用 argpartition 做O(N)的部分选择，只对选出的k条排序
+        """
+        count = len(similarities)
+        top_k = min(top_k, count)
+        if top_k <= 0:
+            return []
+
+        if np is None:
+            selected = heapq.nlargest(top_k, range(count), key=similarities.__getitem__)
+            return [idx for idx in selected if similarities[idx] > 0]
+
+        values = np.asarray(similarities, dtype=np.float64)
+        if top_k < count:
+            threshold = values[np.argpartition(-values, top_k - 1)[:top_k]].min()
+            # 严格大于阈值的全部入选，与阈值相等的按下标顺序补足k条，保证并列时结果确定
+            above = np.flatnonzero(values > threshold)
+            tied = np.flatnonzero(values == threshold)[:top_k - len(above)]
+            candidates = np.sort(np.concatenate((above, tied)))
+        else:
+            candidates = np.arange(count)
+        ordered = candidates[np.argsort(-values[candidates], kind="stable")]
+        return [int(idx) for idx in ordered if values[idx] > 0]
+    
+    def _select_local_memories(self, bot_id: str, group_id: str, user_id: str,
+                               user_query: str, memory_retrieval_number: int,
+                               query_embedding: Optional[List[float]]) -> Tuple[List[Tuple[int, Any]], Dict[str, float]]:
+        """
+        读取整个记忆数组并在本地检索
+
+        返回：([(下标, 记忆条目)] 按相似度降序, 新补齐的向量模长 {点路径: 模长})
         """
         # 获取长期记忆数组
         long_term_memory = self.mongo_system.get_field(bot_id, group_id, user_id, "long_term_memory")
@@ -821,82 +2077,108 @@ class MemoryManager:
         
         # 如果没有记忆，直接返回
         if not long_term_memory or not user_query:
-            return {
-                "hit_memories": [],
-                "enhanced_main_prompt": main_prompt
-            }
-        
-        # 准备文本进行相似度计算
-        # 假设每个记忆条目是字典格式：{"user_input": "...", "memory_description": "...", "hit_count": 0}
-        memory_inputs = []
-        for entry in long_term_memory:
-            if isinstance(entry, dict):
-                user_input = entry.get("user_input", "")
-                if user_input:
-                    memory_inputs.append(user_input)
-            elif isinstance(entry, str):
-                # 如果是字符串格式，直接使用
-                memory_inputs.append(entry)
-        
-        if not memory_inputs:
-            return {
-                "hit_memories": [],
-                "enhanced_main_prompt": main_prompt
-            }
-        
-        # 构建词汇表和向量
-        all_texts = memory_inputs + [user_query]
-        vocabulary = self.build_vocabulary(all_texts)
-        query_vector = self.text_to_vector(user_query, vocabulary)
-        
-        # 计算相似度并获取最相关的记忆
-        similarities = []
-        for i, user_input in enumerate(memory_inputs):
-            if i >= len(long_term_memory):
-                break
-            memory_vector = self.text_to_vector(user_input, vocabulary)
-            similarity = self.cosine_similarity(query_vector, memory_vector)
-            similarities.append((similarity, i))
+            return [], {}
+
+        # 旧的字符串记忆首次检索时迁移为字典条目并整体写回（之后每条记忆都是字典）
+        if any(isinstance(entry, str) for entry in long_term_memory):
+            long_term_memory = [_canonicalize_memory(entry) for entry in long_term_memory]
+            self.mongo_system.update_field(bot_id, group_id, user_id, "long_term_memory", long_term_memory)
         
-        # 获取top-k最相关的记忆
-        similarities.sort(key=lambda x: x[0], reverse=True)
-        top_k = min(memory_retrieval_number, len(similarities))
-        top_indices = [item[1] for item in similarities[:top_k] if item[0] > 0]  # 只保留相似度>0的
+        embedding_field = self._memory_embedding_field(long_term_memory, query_embedding)
+        norms_added: List[int] = []
+        if embedding_field is not None:
+            # 记忆均已向量化：按向量余弦计算相似度（无simsimd时复用各条记忆预存的向量模长）
+            field, norm_field, quantized = embedding_field
+            embeddings = [entry[field] for entry in long_term_memory]
+            norms = None
+            if simsimd is None:
+                norms_added = self._ensure_embedding_norms(long_term_memory, embeddings, norm_field)
+                norms = [entry[norm_field] for entry in long_term_memory]
+            similarities = self.compute_embedding_similarities(embeddings, query_embedding, norms, quantized)
+            positions = range(len(long_term_memory))
+        else:
+            # 查询分不出任何词（纯标点/表情）时词袋相似度必然全为0，不会命中，直接返回
+            if not _tokenize(user_query):
+                return [], {}
+
+            # 准备文本进行相似度计算
+            # 每个记忆条目是字典格式：{"user_input": "...", "memory_description": "...", "hit_count": 0}
+            # 没有user_input的条目不参与计算，记下 (原下标, 文本)，结果映射回原数组下标
+            memory_inputs = [
+                (idx, entry["user_input"]) for idx, entry in enumerate(long_term_memory)
+                if isinstance(entry, dict) and entry.get("user_input")
+            ]
+            
+            if not memory_inputs:
+                return [], {}
+            
+            # 计算相似度（每条记忆只分词一次）
+            positions, texts = zip(*memory_inputs)
+            similarities = self.compute_similarities(list(texts), user_query)
+
+        # 取top-k最相关且相似度>0的记忆（下标为原数组下标，命中计数按位置写回）
+        top_indices = [positions[i] for i in self.select_top_indices(similarities, memory_retrieval_number)]
         
+        norm_updates = {
+            f"long_term_memory.{idx}.{norm_field}": long_term_memory[idx][norm_field]
+            for idx in norms_added
+        }
+        return [(idx, long_term_memory[idx]) for idx in top_indices if idx < len(long_term_memory)], norm_updates
+
+    def get_memory_prompt(self, bot_id: str, group_id: str, user_id: str,
+                         user_query: str, main_prompt: str,
+                         memory_retrieval_number: int = 5,
+                         query_embedding: Optional[List[float]] = None) -> Dict[str, Any]:
+        """
+        获取长期记忆并整合到主提示词中
+        从long_term_memory数组中检索相关记忆
+
+        提供query_embedding且每条记忆都带有同维度的embedding时按向量余弦检索，否则按词袋余弦检索；
+        向量检索在尚未读取记忆数组时由服务端完成（见 MongoDBSystem.search_memories_by_embedding）
+        """
+        # 尚未读取记忆数组时优先在服务端按向量检索，只传回命中的条目
+        searched = None
+        if query_embedding and user_query:
+            searched = self.mongo_system.search_memories_by_embedding(
+                bot_id, group_id, user_id, query_embedding, memory_retrieval_number
+            )
+        if searched is not None:
+            top_entries = [(hit["idx"], hit) for hit in searched]
+            norm_updates: Dict[str, float] = {}
+        else:
+            top_entries, norm_updates = self._select_local_memories(
+                bot_id, group_id, user_id, user_query, memory_retrieval_number, query_embedding
+            )
+
         # 收集命中的记忆并更新命中次数
         hit_memories = []
         memory_descriptions = []
+        hit_indices = []
         
-        for idx in top_indices:
-            if idx < len(long_term_memory):
-                entry = long_term_memory[idx]
+        for idx, entry in top_entries:
+            if isinstance(entry, dict):
+                # 字典格式
+                user_input = entry.get("user_input", "")
+                memory_desc = entry.get("memory_description", "")
+                hit_count = entry.get("hit_count", 0)
                 
-                if isinstance(entry, dict):
-                    # 字典格式
-                    user_input = entry.get("user_input", "")
-                    memory_desc = entry.get("memory_description", "")
-                    hit_count = entry.get("hit_count", 0)
-                    
-                    # 更新命中次数
-                    entry["hit_count"] = hit_count + 1
-                    
-                    hit_memories.append({
-                        "user_input": user_input,
-                        "memory_description": memory_desc,
-                        "hit_count": hit_count + 1
-                    })
-                    
-                    if memory_desc:
-                        memory_descriptions.append(memory_desc)
-                        
-                elif isinstance(entry, str):
-                    # 字符串格式，直接使用
-                    hit_memories.append({"memory_description": entry, "hit_count": 1})
-                    memory_descriptions.append(entry)
-        
-        # 更新数据库中的long_term_memory
-        if hit_memories:
-            self.mongo_system.update_field(bot_id, group_id, user_id, "long_term_memory", long_term_memory)
+                # 记录命中下标，命中次数由 inc_array_field 在数据库中自增
+                hit_indices.append(idx)
+                
+                hit_memories.append({
+                    "user_input": user_input,
+                    "memory_description": memory_desc,
+                    "hit_count": hit_count + 1
+                })
+                
+                if memory_desc:
+                    memory_descriptions.append(memory_desc)
+
+        # 只回写变化的部分：新补齐的向量模长按点路径$set，命中次数按下标$inc
+        if norm_updates:
+            self.mongo_system.update_document(bot_id, group_id, user_id, norm_updates)
+        if hit_indices:
+            self.mongo_system.inc_array_field(bot_id, group_id, user_id, "long_term_memory", hit_indices)
         
         # 构建增强的提示词
         if memory_descriptions:
@@ -911,11 +2193,39 @@ class MemoryManager:
         }
 
 
+# 工作流上下文各字段的默认值（用户标识、输入与可变的列表字段在 _init_context 中按调用填入）
+_CONTEXT_DEFAULTS = types.MappingProxyType({
+    # 工作流状态
+    "stop_reason": None,
+    "stop_message": " ",
+    # 步骤1：黑名单检查结果
+    "block_status": "pass",
+    # 步骤2：输入长度检查结果
+    "input_length": 0,
+    "max_input_length": 0,
+    # 步骤3：用量限制检查结果
+    "current_usage": 0,
+    "usage_limit": 0,
+    "usage_date": "",
+    # 步骤4：好感度结果
+    "favor_value": 0,
+    "favor_prompt": "",
+    # 步骤5：用户画像结果
+    "persona_text": "",
+    # 步骤6：上下文结果
+    "context_text": "",
+    "context_count": 0,
+    # 主提示词拆分：main_prompt == static_prefix + dynamic_suffix
+    "dynamic_suffix": "",
+})
+
+
 class IntegratedWorkflow:
     """整合的工作流程序"""
     
-    def __init__(self, mongo_url: str):
-        self.mongo_system = MongoDBSystem(mongo_url)
+    def __init__(self, mongo_url: str, cache_ttl: float = 0,
+                 mongo_system: Optional[MongoDBSystem] = None):
+        self.mongo_system = mongo_system or MongoDBSystem(mongo_url, cache_ttl=cache_ttl)
         self.blacklist_manager = BlacklistManager(self.mongo_system)
         self.usage_limit_manager = UsageLimitManager(self.mongo_system)
         self.favor_manager = FavorManager(self.mongo_system)
@@ -926,40 +2236,69 @@ class IntegratedWorkflow:
 
     def _init_context(self, bot_id: str, group_id: str, user_id: str,
                       user_query: str, main_prompt: str) -> Dict[str, Any]:
-        """初始化工作流上下文，设置所有字段的默认值"""
+        """初始化工作流上下文，设置所有字段的默认值（无论在哪一步结束，返回的字段都完整）"""
         return {
-            # 工作流状态
-            "stop_reason": None,
-            "stop_message": " ",
-            # 用户标识
+            **_CONTEXT_DEFAULTS,
             "bot_id": bot_id,
             "group_id": group_id,
             "user_id": user_id,
-            # 输入
             "user_query": user_query,
-            # 输出
             "main_prompt": main_prompt,
-            # 步骤1：黑名单检查结果
-            "block_status": "pass",
-            # 步骤2：输入长度检查结果
-            "input_length": 0,
-            "max_input_length": 0,
-            # 步骤3：用量限制检查结果
-            "current_usage": 0,
-            "usage_limit": 0,
-            "usage_date": "",
-            # 步骤4：好感度结果
-            "favor_value": 0,
-            "favor_prompt": "",
-            # 步骤5：用户画像结果
-            "persona_text": "",
-            # 步骤6：上下文结果
-            "context_text": "",
-            "context_count": 0,
-            # 步骤7：记忆结果
+            "static_prefix": main_prompt,
             "hit_memories": [],
         }
 
+    def _request_fields(self, blacklist_system: Any, usage_limit_system: Any,
+                        favor_system: Any, persona_system: Any,
+                        context_system: Any, context_pool_size: str,
+                        memory_system: Any,
+                        memory_query_embedding: Optional[List[float]] = None) -> Tuple[Tuple[str, ...], int]:
+        """
+        按开启的功能计算本次请求需要读取的字段和历史条数
+
+        提供了查询向量且支持服务端记忆检索时不预取记忆数组，由服务端只传回命中的记忆
+        """
+        fields: List[str] = []
+        if blacklist_system:
+            fields.append("block_stats")
+        if usage_limit_system:
+            fields.extend(("daily_usage_count", "updated_at"))
+        if favor_system:
+            fields.append("favor_value")
+        if persona_system:
+            fields.append("persona_attributes")
+        if memory_system and not (memory_query_embedding and self.mongo_system.SERVER_MEMORY_SEARCH):
+            fields.append("long_term_memory")
+        history_count = _fast_int(context_pool_size, 0) if context_system else 0
+        return tuple(fields), history_count
+
+    def begin_request(self, context: Dict[str, Any], *system_options: Any, refresh: bool = False,
+                      memory_query_embedding: Optional[List[float]] = None):
+        """按开启的功能一次读取各步骤需要的字段，各步骤的写入在 finish_request 时合并提交"""
+        fields, history_count = self._request_fields(*system_options, memory_query_embedding)
+        self.mongo_system.begin_request(
+            context["bot_id"], context["group_id"], context["user_id"], fields, history_count,
+            refresh=refresh
+        )
+
+    def finish_request(self, check_version: bool = True) -> bool:
+        """提交本次请求暂存的全部写入，返回False表示版本冲突、写入未生效"""
+        return self.mongo_system.flush_request(check_version)
+
+    async def begin_request_async(self, context: Dict[str, Any], *system_options: Any,
+                                  refresh: bool = False,
+                                  memory_query_embedding: Optional[List[float]] = None):
+        """异步版本的 begin_request（需使用 MongoDBSystemAsync）"""
+        fields, history_count = self._request_fields(*system_options, memory_query_embedding)
+        await self.mongo_system.begin_request_async(
+            context["bot_id"], context["group_id"], context["user_id"], fields, history_count,
+            refresh=refresh
+        )
+
+    async def finish_request_async(self, check_version: bool = True) -> bool:
+        """异步版本的 finish_request"""
+        return await self.mongo_system.flush_request_async(check_version)
+
     def check_blacklist(self, context: Dict[str, Any],
                        blacklist_system: Any, is_user_admin: Any,
                        blacklist_restrict_admin_users: Any,
@@ -967,19 +2306,15 @@ class IntegratedWorkflow:
                        timestamp: float) -> Dict[str, Any]:
         """黑名单检查"""
         # 判断是否需要执行黑名单检查
-        skip_check = (
-            not blacklist_system or
-            (blacklist_system and
-             not blacklist_restrict_admin_users and
-             is_user_admin)
-        )
+        # 未开启，或开启但不限制管理员且当前用户是管理员（第二项只在已开启时才会求值）
+        skip_check = not blacklist_system or (not blacklist_restrict_admin_users and is_user_admin)
 
         if skip_check:
             return context
 
         # 执行黑名单检查
-        warn_lifespan_int = self.util.safe_int_convert(warn_lifespan, 0)
-        block_lifespan_int = self.util.safe_int_convert(block_lifespan, 0)
+        warn_lifespan_int = _fast_int(warn_lifespan, 0)
+        block_lifespan_int = _fast_int(block_lifespan, 0)
 
         check_result = self.blacklist_manager.check_blacklist_status(
             bot_id=context["bot_id"],
@@ -1003,7 +2338,7 @@ class IntegratedWorkflow:
                           max_input_size: str,
                           overinput_output: Any = None) -> Dict[str, Any]:
         """输入长度检查"""
-        max_length = self.util.safe_int_convert(max_input_size, 0)
+        max_length = _fast_int(max_input_size, 0)
         input_length = len(context["user_query"]) if context["user_query"] else 0
 
         context["input_length"] = input_length
@@ -1023,17 +2358,13 @@ class IntegratedWorkflow:
                          overusage_output: Any) -> Dict[str, Any]:
         """用量限制检查"""
         # 判断是否需要执行用量限制检查
-        skip_check = (
-            not usage_limit_system or
-            (usage_limit_system and
-             not usage_restrict_admin_users and
-             is_user_admin)
-        )
+        # 未开启，或开启但不限制管理员且当前用户是管理员（第二项只在已开启时才会求值）
+        skip_check = not usage_limit_system or (not usage_restrict_admin_users and is_user_admin)
 
         if skip_check:
             return context
 
-        usage_limit_int = self.util.safe_int_convert(usage_limit, 0)
+        usage_limit_int = _fast_int(usage_limit, 0)
 
         check_result = self.usage_limit_manager.check_usage_limit(
             bot_id=context["bot_id"],
@@ -1108,7 +2439,7 @@ class IntegratedWorkflow:
         if not context_system:
             return context
 
-        pool_size = self.util.safe_int_convert(context_pool_size, 0)
+        pool_size = _fast_int(context_pool_size, 0)
 
         result = self.context_manager.get_context_prompt(
             bot_id=context["bot_id"],
@@ -1126,12 +2457,13 @@ class IntegratedWorkflow:
 
     def generate_memory_prompt(self, context: Dict[str, Any],
                              memory_system: Any,
-                             memory_retrieval_number: str) -> Dict[str, Any]:
+                             memory_retrieval_number: str,
+                             query_embedding: Optional[List[float]] = None) -> Dict[str, Any]:
         """长期记忆提示词生成"""
         if not memory_system:
             return context
 
-        retrieval_num = self.util.safe_int_convert(memory_retrieval_number, 5)
+        retrieval_num = _fast_int(memory_retrieval_number, 5)
 
         result = self.memory_manager.get_memory_prompt(
             bot_id=context["bot_id"],
@@ -1139,7 +2471,8 @@ class IntegratedWorkflow:
             user_id=context["user_id"],
             user_query=context["user_query"],
             main_prompt=context["main_prompt"],
-            memory_retrieval_number=retrieval_num
+            memory_retrieval_number=retrieval_num,
+            query_embedding=query_embedding
         )
 
         context["hit_memories"] = result["hit_memories"]
@@ -1148,6 +2481,84 @@ class IntegratedWorkflow:
         return context
 
 
+@functools.lru_cache(maxsize=4)
+def _get_workflow(mongo_url: str, cache_ttl: float) -> IntegratedWorkflow:
+    """按 (URL, 缓存有效期) 复用工作流实例及其MongoDB系统与各管理器（每次调用的请求状态按上下文隔离）"""
+    return IntegratedWorkflow(mongo_url, cache_ttl=cache_ttl)
+
+
+def _as_flags(*flags: Any) -> Tuple[bool, ...]:
+    """把功能开关参数（bool/int等）按真值转换为bool"""
+    return tuple(map(bool, flags))
+
+
+def _run_steps(
+    workflow: IntegratedWorkflow,
+    context: Dict[str, Any],
+    blacklist_system: bool, is_user_admin: bool, blacklist_restrict_admin_users: bool,
+    warn_lifespan: str, block_lifespan: str, timestamp: float,
+    max_input_size: str, overinput_output: Any,
+    usage_limit_system: bool, usage_restrict_admin_users: bool, usage_limit: str,
+    year: str, month: str, day: str, overusage_output: Any,
+    favor_system: bool, favor_prompts: Optional[List[str]], favor_split_points: Optional[List[int]],
+    persona_system: bool,
+    context_system: bool, context_pool_size: str,
+    memory_system: bool, memory_retrieval_number: str,
+    memory_query_embedding: Optional[List[float]] = None
+) -> Dict[str, Any]:
+    """依次执行工作流各步骤（main 与 main_async 共用），参数含义同 main，功能开关已转换为bool"""
+    # 步骤1：黑名单检查
+    context = workflow.check_blacklist(
+        context,
+        blacklist_system, is_user_admin, blacklist_restrict_admin_users,
+        warn_lifespan, block_lifespan, timestamp
+    )
+    if context["stop_reason"] is not None:
+        return context
+
+    # 步骤2：输入长度检查
+    context = workflow.check_input_length(context, max_input_size, overinput_output)
+    if context["stop_reason"] is not None:
+        return context
+
+    # 步骤3：用量限制检查
+    context = workflow.check_usage_limit(
+        context,
+        usage_limit_system, usage_restrict_admin_users, is_user_admin,
+        usage_limit, year, month, day, overusage_output
+    )
+    if context["stop_reason"] is not None:
+        return context
+
+    # 步骤4~7只读取请求开始时一次取回的快照（不再访问数据库），按顺序在主提示词后追加各自的片段；
+    # 并发执行不会减少往返次数，反而要额外拼接片段，因此保持顺序执行
+
+    # 步骤4：好感度提示词生成
+    context = workflow.generate_favor_prompt(context, favor_system, favor_prompts, favor_split_points)
+
+    # 步骤5：用户画像提示词生成
+    context = workflow.generate_persona_prompt(context, persona_system)
+
+    # 好感度阶段与用户画像在会话内很少变化，到此为止的主提示词作为可缓存的静态前缀，
+    # 之后逐轮变化的上下文与记忆片段放在动态后缀中（调用方可在前缀末尾设置LLM的提示词缓存断点）
+    context["static_prefix"] = context["main_prompt"]
+
+    # 步骤6：上下文提示词生成
+    context = workflow.generate_context_prompt(context, context_system, context_pool_size)
+
+    # 步骤7：长期记忆提示词生成
+    context = workflow.generate_memory_prompt(
+        context, memory_system, memory_retrieval_number, memory_query_embedding
+    )
+
+    context["dynamic_suffix"] = context["main_prompt"][len(context["static_prefix"]):]
+
+    # 标记工作流成功完成
+    context["stop_reason"] = "finish"
+
+    return context
+
+
 def main(
     # 基础参数
     bot_id: str,
@@ -1198,7 +2609,12 @@ def main(
 
     # 长期记忆提示词参数
     memory_system: Any = 0,
-    memory_retrieval_number: str = "5"
+    memory_retrieval_number: str = "5",
+    # 用户输入的向量（可选，由上游embedding节点生成）；记忆均带有embedding时按向量检索
+    memory_query_embedding: Optional[List[float]] = None,
+
+    # 用户字段进程内缓存有效期（秒），"0"表示关闭
+    field_cache_ttl: str = "0"
 ) -> Dict[str, Any]:
     """
     整合工作流主函数
@@ -1213,54 +2629,172 @@ def main(
     7. 长期记忆提示词生成 -> 返回最终结果
 
     返回：包含完整字段的字典（无论在哪一步结束）
+
+    field_cache_ttl > 0 时，好感度/画像/黑名单/用量等小字段在该秒数内复用进程内缓存；
+    其他节点对同一用户的写入最多延迟该秒数才可见
     """
 
+    # 功能开关在入口统一按真值转换为bool，之后各步骤只做布尔判断
+    (blacklist_system, is_user_admin, blacklist_restrict_admin_users,
+     usage_limit_system, usage_restrict_admin_users,
+     favor_system, persona_system, context_system, memory_system) = _as_flags(
+        blacklist_system, is_user_admin, blacklist_restrict_admin_users,
+        usage_limit_system, usage_restrict_admin_users,
+        favor_system, persona_system, context_system, memory_system
+    )
+
     # 初始化工作流
-    workflow = IntegratedWorkflow(MONGO_URL)
+    try:
+        cache_ttl = float(field_cache_ttl)
+    except (TypeError, ValueError):
+        cache_ttl = 0.0
+    workflow = _get_workflow(MONGO_URL, cache_ttl)
 
-    # 设置跨群配置
+    # 设置跨群配置（每次调用都重新设置，只作用于本次调用）
     workflow.mongo_system.set_cross_group_config(favor_cross_group, persona_cross_group, blacklist_cross_group, usage_limit_cross_group)
 
-    # 初始化上下文
-    context = workflow._init_context(bot_id, group_id, user_id, user_query, main_prompt)
+    # 一次读取各步骤需要的字段，无论在哪一步结束，都在返回前合并提交本次写入；
+    # 提交时文档已被并发请求修改（_v变化）则用新读取的文档重新执行各步骤
+    for attempt in range(REQUEST_MAX_ATTEMPTS):
+        context = workflow._init_context(bot_id, group_id, user_id, user_query, main_prompt)
+        workflow.begin_request(
+            context,
+            blacklist_system, usage_limit_system, favor_system, persona_system,
+            context_system, context_pool_size, memory_system,
+            refresh=attempt > 0, memory_query_embedding=memory_query_embedding
+        )
+        try:
+            context = _run_steps(
+                workflow, context,
+                blacklist_system=blacklist_system, is_user_admin=is_user_admin,
+                blacklist_restrict_admin_users=blacklist_restrict_admin_users,
+                warn_lifespan=warn_lifespan, block_lifespan=block_lifespan, timestamp=timestamp,
+                max_input_size=max_input_size, overinput_output=overinput_output,
+                usage_limit_system=usage_limit_system, usage_restrict_admin_users=usage_restrict_admin_users,
+                usage_limit=usage_limit, year=year, month=month, day=day, overusage_output=overusage_output,
+                favor_system=favor_system, favor_prompts=favor_prompts, favor_split_points=favor_split_points,
+                persona_system=persona_system,
+                context_system=context_system, context_pool_size=context_pool_size,
+                memory_system=memory_system, memory_retrieval_number=memory_retrieval_number,
+                memory_query_embedding=memory_query_embedding
+            )
+        except Exception:
+            workflow.finish_request(check_version=False)
+            raise
+        if workflow.finish_request(check_version=attempt + 1 < REQUEST_MAX_ATTEMPTS):
+            break
 
-    # 步骤1：黑名单检查
-    context = workflow.check_blacklist(
-        context,
-        blacklist_system, is_user_admin, blacklist_restrict_admin_users,
-        warn_lifespan, block_lifespan, timestamp
-    )
-    if context["stop_reason"] is not None:
-        return context
+    # 返回完整结果
+    return context
 
-    # 步骤2：输入长度检查
-    context = workflow.check_input_length(context, max_input_size, overinput_output)
-    if context["stop_reason"] is not None:
-        return context
 
-    # 步骤3：用量限制检查
-    context = workflow.check_usage_limit(
-        context,
-        usage_limit_system, usage_restrict_admin_users, is_user_admin,
-        usage_limit, year, month, day, overusage_output
-    )
-    if context["stop_reason"] is not None:
-        return context
+async def main_async(
+    # 基础参数
+    bot_id: str,
+    group_id: str,
+    user_id: str,
+    user_query: str,
+    main_prompt: str,
+    MONGO_URL: str,
 
-    # 步骤4：好感度提示词生成
-    context = workflow.generate_favor_prompt(context, favor_system, favor_prompts, favor_split_points)
+    # 跨群配置参数（支持bool/str/int，自动转换为bool内部处理）
+    favor_cross_group: Any = False,
+    persona_cross_group: Any = False,
+    blacklist_cross_group: Any = False,
+    usage_limit_cross_group: Any = False,
 
-    # 步骤5：用户画像提示词生成
-    context = workflow.generate_persona_prompt(context, persona_system)
+    # 黑名单检查参数
+    blacklist_system: Any = 0,
+    is_user_admin: Any = 0,
+    blacklist_restrict_admin_users: Any = 0,
+    warn_lifespan: str = "0",
+    block_lifespan: str = "0",
+    timestamp: float = 0.0,
 
-    # 步骤6：上下文提示词生成
-    context = workflow.generate_context_prompt(context, context_system, context_pool_size)
+    # 输入长度检查参数
+    max_input_size: str = "0",
+    overinput_output: Any = None,
 
-    # 步骤7：长期记忆提示词生成
-    context = workflow.generate_memory_prompt(context, memory_system, memory_retrieval_number)
+    # 用量限制检查参数
+    usage_limit_system: Any = 0,
+    usage_restrict_admin_users: Any = 0,
+    usage_limit: str = "0",
+    year: str = "1970",
+    month: str = "01",
+    day: str = "01",
+    overusage_output: Any = None,
 
-    # 标记工作流成功完成
-    context["stop_reason"] = "finish"
+    # 好感度提示词参数
+    favor_system: Any = 0,
+    favor_prompts: Optional[List[str]] = None,
+    favor_split_points: Optional[List[int]] = None,
+
+    # 用户画像提示词参数
+    persona_system: Any = 0,
+
+    # 上下文提示词参数
+    context_system: Any = 0,
+    context_pool_size: str = "0",
+
+    # 长期记忆提示词参数
+    memory_system: Any = 0,
+    memory_retrieval_number: str = "5",
+    # 用户输入的向量（可选，由上游embedding节点生成）；记忆均带有embedding时按向量检索
+    memory_query_embedding: Optional[List[float]] = None,
+
+    # 用户字段进程内缓存有效期（秒），"0"表示关闭
+    field_cache_ttl: str = "0"
+) -> Dict[str, Any]:
+    """
+    整合工作流主函数（异步版本）
+
+    供运行在事件循环中的调用方使用，参数与返回值同 main；
+    数据库读写通过AsyncMongoClient完成，不阻塞事件循环
+    """
+    # 功能开关在入口统一按真值转换为bool，之后各步骤只做布尔判断
+    (blacklist_system, is_user_admin, blacklist_restrict_admin_users,
+     usage_limit_system, usage_restrict_admin_users,
+     favor_system, persona_system, context_system, memory_system) = _as_flags(
+        blacklist_system, is_user_admin, blacklist_restrict_admin_users,
+        usage_limit_system, usage_restrict_admin_users,
+        favor_system, persona_system, context_system, memory_system
+    )
+
+    try:
+        cache_ttl = float(field_cache_ttl)
+    except (TypeError, ValueError):
+        cache_ttl = 0.0
+    workflow = IntegratedWorkflow(
+        MONGO_URL, mongo_system=MongoDBSystemAsync(MONGO_URL, cache_ttl=cache_ttl)
+    )
+    workflow.mongo_system.set_cross_group_config(favor_cross_group, persona_cross_group, blacklist_cross_group, usage_limit_cross_group)
+    for attempt in range(REQUEST_MAX_ATTEMPTS):
+        context = workflow._init_context(bot_id, group_id, user_id, user_query, main_prompt)
+        await workflow.begin_request_async(
+            context,
+            blacklist_system, usage_limit_system, favor_system, persona_system,
+            context_system, context_pool_size, memory_system,
+            refresh=attempt > 0, memory_query_embedding=memory_query_embedding
+        )
+        try:
+            context = _run_steps(
+                workflow, context,
+                blacklist_system=blacklist_system, is_user_admin=is_user_admin,
+                blacklist_restrict_admin_users=blacklist_restrict_admin_users,
+                warn_lifespan=warn_lifespan, block_lifespan=block_lifespan, timestamp=timestamp,
+                max_input_size=max_input_size, overinput_output=overinput_output,
+                usage_limit_system=usage_limit_system, usage_restrict_admin_users=usage_restrict_admin_users,
+                usage_limit=usage_limit, year=year, month=month, day=day, overusage_output=overusage_output,
+                favor_system=favor_system, favor_prompts=favor_prompts, favor_split_points=favor_split_points,
+                persona_system=persona_system,
+                context_system=context_system, context_pool_size=context_pool_size,
+                memory_system=memory_system, memory_retrieval_number=memory_retrieval_number,
+                memory_query_embedding=memory_query_embedding
+            )
+        except Exception:
+            await workflow.finish_request_async(check_version=False)
+            raise
+        if await workflow.finish_request_async(check_version=attempt + 1 < REQUEST_MAX_ATTEMPTS):
+            break
 
-    # 返回完整结果
     return context